@@ -1,15 +1,27 @@
 import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from alpaca.trading.client import TradingClient
 from alpaca.trading.requests import MarketOrderRequest, TrailingStopOrderRequest, TakeProfitRequest, StopLossRequest, GetOrdersRequest
-from alpaca.trading.enums import OrderSide, TimeInForce, OrderType
+from alpaca.trading.enums import OrderSide, TimeInForce, OrderType, QueryOrderStatus
+from core.log import get_logger
+from core.orders import OrderHandle, OrderTracker
+from core.ratelimit import get_limiter
 from env import ALPACA_API_KEY, ALPACA_SECRET_KEY
 
+logger = get_logger(__name__)
+
+# order statuses that still count as waiting to be filled
+OPEN_STATUSES = ('new', 'accepted', 'held', 'partially_filled', 'done_for_day', 'pending_new',
+                 'accepted_for_bidding', 'pending_cancel', 'pending_replace', 'calculated')
+
 class AlpacaTrading:
     """
     A class for performing trading operations using the Alpaca API.
     """
 
-    def __init__(self, api_key: str, api_secret: str, paper: bool=True):
+    def __init__(self, api_key: str, api_secret: str, paper: bool=True, limiter=None, order_workers: int=4, session=None):
         """
         Initialize the AlpacaTrading object.
 
@@ -17,9 +29,89 @@ class AlpacaTrading:
             api_key (str): The Alpaca API key.
             api_secret (str): The Alpaca API secret key.
             base_url (str, optional): The Alpaca API base URL. Defaults to 'https://paper-api.alpaca.markets'.
+            limiter (RateLimiter, optional): throttles and retries the api calls.
+                Defaults to the shared get_limiter('alpaca').
+            order_workers (int, optional): how many orders buy_async / sell_async
+                can be submitting at once.
+            session (Session, optional): keep-alive session for the api calls,
+                see core.sessions.make_session.
         """
         self.api = TradingClient(api_key=api_key, secret_key=api_secret, paper=paper)
-        self.account = self.api.get_account()
+        if session is not None:
+            # alpaca-py has no option for it, it makes its own session in _session
+            self.api._session = session
+        self.limiter = limiter or get_limiter('alpaca')
+        self.account = self.limiter.call(self.api.get_account)
+
+        # symbol: {order id: status} of the orders that are still open, loaded
+        # in one call and then kept up to date from the trade updates stream.
+        # replaced as a whole on every change so readers dont need the lock
+        self.open_orders = {}
+        # ids of orders we know are done, so a late submit response cant
+        # put an order the stream already closed back in the index
+        self._closed_orders = OrderedDict()
+        self._orders_lock = threading.Lock()
+        self.refresh_orders()
+
+        # orders placed with buy_async / sell_async
+        self.orders = OrderTracker()
+        self._order_pool = ThreadPoolExecutor(max_workers=order_workers, thread_name_prefix="orders")
+
+    def refresh_orders(self):
+        """ reloads every open order with a single get_orders call, drops any
+            order the stream missed closing (eg while it was disconnected)
+        """
+        order_request = GetOrdersRequest(status=QueryOrderStatus.OPEN, limit=500)
+        orders = self.limiter.call(self.api.get_orders, order_request)
+        with self._orders_lock:
+            open_orders = {}
+            for order in orders:
+                # closed by the stream while the request was in flight
+                if str(order.id) in self._closed_orders:
+                    continue
+                open_orders.setdefault(order.symbol, {})[str(order.id)] = _status(order.status)
+            self.open_orders = open_orders
+
+    def apply_trade_update(self, update: dict):
+        """ keeps the open order index up to date from a trade update
+
+        Args:
+            update: (dict) the "data" of a trade_updates message
+                {"event": "new", "order": {"id": "...", "symbol": "AAPL", "status": "new", ...}}
+        """
+        order = update.get("order")
+        if not order:
+            return
+        self._track_order(order["symbol"], order["id"], order.get("status"))
+        self.orders.apply_trade_update(update)
+
+    def get_open_orders(self, symbol: str) -> dict:
+        """ Returns:
+                dict: order id: status of every open order for the symbol,
+                    from the local index
+        """
+        return dict(self.open_orders.get(symbol, {}))
+
+    def _track_order(self, symbol, order_id, status):
+        status = _status(status)
+        order_id = str(order_id)
+        with self._orders_lock:
+            orders = dict(self.open_orders.get(symbol, {}))
+            if status in OPEN_STATUSES:
+                if order_id in self._closed_orders:
+                    return
+                orders[order_id] = status
+            else:
+                orders.pop(order_id, None)
+                self._closed_orders[order_id] = True
+                while len(self._closed_orders) > 1000:
+                    self._closed_orders.popitem(last=False)
+            open_orders = dict(self.open_orders)
+            if orders:
+                open_orders[symbol] = orders
+            else:
+                open_orders.pop(symbol, None)
+            self.open_orders = open_orders
 
     def get_order(self, symbol: str) -> dict:
         """ Returns the order for the given symbol
@@ -35,14 +127,27 @@ class AlpacaTrading:
         """
 
         order_request = GetOrdersRequest(symbols=[symbol])
-        orders = self.api.get_orders(order_request)
+        orders = self.limiter.call(self.api.get_orders, order_request)
 
         if len(orders) == 0:
             raise Exception("order not found")
         else:
             return orders[0]
 
-    def buy(self, symbol: str, qty: int, limit_price: float=None, trail_percent: float=6) -> dict:
+    def has_pending_order(self, symbol: str) -> bool:
+        """ Returns:
+                bool: True if there is an open (not yet filled or canceled)
+                    order for the given symbol, checked in the local index
+        """
+        return symbol in self.open_orders
+
+    def get_clock(self):
+        """ Returns:
+                Clock: the market clock (is_open, next_open, next_close)
+        """
+        return self.limiter.call(self.api.get_clock)
+
+    def buy(self, symbol: str, qty: int, limit_price: float=None, trail_percent: float=6, client_order_id: str=None) -> dict:
         """
         Place a buy order for the specified symbol.
 
@@ -51,6 +156,7 @@ class AlpacaTrading:
             qty (int): The quantity of shares to buy.
             limit_price (float, optional): The limit price for the buy order. Defaults to None.
             stop_price (float, optional): The stop price for the buy order. Defaults to None.
+            client_order_id (str, optional): Our own id for the order.
 
         Returns:
             dict: The buy order response from the Alpaca API.
@@ -61,6 +167,9 @@ class AlpacaTrading:
             Exception: "existing pending order" if there is an existing order
         """
 
+        if self.has_pending_order(symbol):
+            raise Exception("existing pending order")
+
         market_order_data = TrailingStopOrderRequest(
             symbol=symbol,
             qty=qty,
@@ -69,12 +178,15 @@ class AlpacaTrading:
             time_in_force=TimeInForce.GTC,
             limit_price=limit_price,
             trail_percent=trail_percent,
+            client_order_id=client_order_id,
         )
-        market_order = self.api.submit_order(market_order_data)
+        # an order must not be placed twice so only rejected (429) calls are retried
+        market_order = self.limiter.call_once(self.api.submit_order, market_order_data)
+        self._track_order(symbol, market_order.id, market_order.status)
         return market_order
 
 
-    def sell(self, symbol: str, qty: int=None, limit_price: float=None, percentage: float=None) -> dict:
+    def sell(self, symbol: str, qty: int=None, limit_price: float=None, percentage: float=None, position_qty: float=None, client_order_id: str=None) -> dict:
         """
         Place a sell order for the specified symbol.
 
@@ -84,6 +196,9 @@ class AlpacaTrading:
                 **Does not work if percentage is set**.
             limit_price (float, optional): The limit price for the sell order. Defaults to None.
             percentage (float, optional): How much of the stock you want to sell (only works if factional shares is enabled)
+            position_qty (float, optional): The size of the position if it is already
+                known (eg from Portfolio), saves asking alpaca for it.
+            client_order_id (str, optional): Our own id for the order.
 
         Returns:
             dict: The sell order response from the Alpaca API.
@@ -92,39 +207,25 @@ class AlpacaTrading:
             fractional shares error: may throw error if frational shares is not enabled
                 (only if percentage is set)
             position does not exist: will be thrown on non existant positions
+            Exception: "existing pending order" if there is an existing order
         """
 
+        # we have an exitsing order for this symbol so we should wait for
+        # it to resolve. orders should only last a day before failing
+        if self.has_pending_order(symbol):
+            raise Exception("existing pending order")
+
         # get/check if there even is an open position
-        position = self.api.get_open_position(symbol)
+        if position_qty is None and (qty is None or percentage is not None):
+            position_qty = float(self.limiter.call(self.api.get_open_position, symbol).qty)
 
         # sell the whole posistion as if neither qty or percentage is set
         if percentage is None and qty is None:
-            qty = float(position.qty)
-
-        existing_order = False
-        try:
-            # check if there is an unfulfilled order
-            try:
-                order = self.get_order(symbol=symbol)
-                if order.symbol == symbol and order.status in ['new', 'accepted', 'held', 'partially_filled', 'done_for_day', 'pending_new', 'accepted_for_bidding']:
-                    # we have an exitsing order for this symbol so we should wait for
-                    # it to resolve. orders should only last a day before failing
-                    # (dont raise exception here because it will do nothing)
-                    existing_order = True
-            except Exception as error:
-                pass
-            
-            
-        except Exception as error:
-            print(error)
-            # should be safe to sell
-
-        if existing_order:
-            raise Exception("existing pending order")
+            qty = position_qty
 
         # adjust the qty if percentage is set
         if percentage is not None:
-            qty = float(position.qty) * percentage
+            qty = position_qty * percentage
 
         market_order_data = MarketOrderRequest(
             symbol=symbol,
@@ -132,10 +233,65 @@ class AlpacaTrading:
             side=OrderSide.SELL,
             type=OrderType.LIMIT if limit_price is not None else OrderType.MARKET,
             time_in_force=TimeInForce.DAY,
+            client_order_id=client_order_id,
         )
-        market_order = self.api.submit_order(market_order_data)
+        market_order = self.limiter.call_once(self.api.submit_order, market_order_data)
+        self._track_order(symbol, market_order.id, market_order.status)
         return market_order
 
+    def buy_async(self, symbol: str, qty: int, callback=None, **kwargs) -> OrderHandle:
+        """
+        Place a buy order without waiting for it, takes the same arguments as buy.
+
+        Args:
+            callback (function, optional): called with the handle once the order is
+                filled, canceled or rejected.
+
+        Returns:
+            OrderHandle: updated in the background as the order is submitted and filled,
+                errors from buy end up in handle.error with the status 'rejected'.
+        """
+        return self._submit_async(self.buy, symbol, 'buy', callback, qty=qty, **kwargs)
+
+    def sell_async(self, symbol: str, callback=None, **kwargs) -> OrderHandle:
+        """
+        Place a sell order without waiting for it, takes the same arguments as sell.
+        See buy_async.
+        """
+        return self._submit_async(self.sell, symbol, 'sell', callback, **kwargs)
+
+    def poll_orders(self, max_age: float=60):
+        """
+        Look up the async orders that havent had a trade update for max_age seconds,
+        so their handles still finish (and run their callbacks) if the stream missed
+        the update.
+
+        Args:
+            max_age (float, optional): seconds without an update before an order is looked up.
+        """
+        for handle in self.orders.stale(max_age):
+            try:
+                order = self.limiter.call(self.api.get_order_by_client_id, handle.client_order_id)
+            except Exception as error:
+                logger.warning("could not look up the %s order for %s: %s", handle.side, handle.symbol, error)
+                continue
+            self._track_order(handle.symbol, order.id, order.status)
+            self.orders.apply_order(handle, order)
+
+    def _submit_async(self, place_order, symbol, side, callback, **kwargs):
+        handle = self.orders.create(symbol, side, callback=callback)
+
+        def submit():
+            try:
+                order = place_order(symbol=symbol, client_order_id=handle.client_order_id, **kwargs)
+            except Exception as error:
+                self.orders.failed(handle, error)
+                return
+            self.orders.submitted(handle, order)
+
+        self._order_pool.submit(submit)
+        return handle
+
     def get_positions(self) -> list:
         """
         Get the current open positions.
@@ -143,7 +299,7 @@ class AlpacaTrading:
         Returns:
             list: A list of position objects representing the current open positions.
         """
-        positions = self.api.get_all_positions()
+        positions = self.limiter.call(self.api.get_all_positions)
         return positions
 
     def get_available_cash(self) -> float:
@@ -153,6 +309,10 @@ class AlpacaTrading:
         Returns:
             float: The available cash amount in the account.
         """
-        self.account = self.api.get_account()
+        self.account = self.limiter.call(self.api.get_account)
         available_cash = float(self.account.buying_power)
-        return available_cash
\ No newline at end of file
+        return available_cash
+
+def _status(status):
+    """the status as a plain string, alpaca-py gives us enums and the stream gives strings"""
+    return str(getattr(status, 'value', status))
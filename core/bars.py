@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+from datetime import timedelta
+
+import pandas as pd
+import yfinance as yf
+from core.log import get_logger
+from core.ratelimit import get_limiter
+
+logger = get_logger(__name__)
+
+COLUMNS = ['Open', 'Close', 'Low', 'High', 'Volume']
+
+class BarCache:
+    """ In memory store of recent OHLCV bars per symbol so we dont have to
+        download the full 5 days of bars every time news drops.
+
+        the first request for a symbol downloads the full period, after that
+        only the bars since the last cached bar are downloaded and merged in.
+        bars older than the period (eg a cache_dir from weeks ago) are thrown
+        away and the symbol is seeded again.
+        if the bars were fetched less than max_age seconds ago nothing is
+        downloaded at all.
+
+        usage example:
+            bars = BarCache(cache_dir='bars')
+            dataframe = bars.get('AAPL')
+
+    Args:
+        period: (str) how much history to seed a symbol with (yfinance period)
+        interval: (str) bar interval (yfinance interval)
+        max_bars: (int) how many bars to keep per symbol, 5 days of 15 min
+            bars during market hours is 130
+        max_age: (float) seconds the cached bars are considered fresh for
+        cache_dir: (str) optional folder to persist the bars in so they survive
+            a restart, nothing is written to disk if this is None
+        limiter: (RateLimiter) throttles and retries the downloads, defaults to
+            the shared get_limiter('yfinance')
+        session: (Session) optional keep-alive session for the single symbol
+            Ticker.history downloads, see core.sessions.make_session
+    """
+
+    def __init__(self, period='5d', interval='15m', max_bars=130, max_age=60, cache_dir=None, limiter=None, session=None):
+        self.period = period
+        self.interval = interval
+        self.max_bars = max_bars
+        self.max_age = max_age
+        self.cache_dir = cache_dir
+        self.limiter = limiter or get_limiter('yfinance')
+        self.session = session
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # symbol: dataframe
+        self.bars = {}
+        # symbol: time.time() of the last successful download
+        self.fetched_at = {}
+        self.stats = {
+            "hits": 0,
+            "seeds": 0,
+            "top_ups": 0,
+        }
+
+        self._lock = threading.Lock()
+        self._symbol_locks = {}
+
+    def get(self, symbol: str) -> pd.DataFrame:
+        """ Returns the cached bars for the given symbol, downloading only what
+            is missing
+
+        Args:
+            symbol: (str) the stock symbol
+
+        Returns:
+            DataFrame: bars with the Open, Close, Low, High and Volume columns
+        """
+        with self._symbol_lock(symbol):
+            if self.is_fresh(symbol):
+                self.stats["hits"] += 1
+                return self.bars[symbol]
+            return self._refresh(symbol)
+
+    def prefetch(self, symbols: list):
+        """ Brings the bars for several symbols up to date with one bulk
+            download, use this when news is tagged with more than one symbol
+            so each symbol doesnt pay for its own round trip. get() calls for
+            these symbols from other threads wait for the prefetch to finish.
+
+        Args:
+            symbols: (list) the stock symbols to fetch
+        """
+        symbols = sorted(set(symbols))
+        # always lock in the same order so two prefetches cant deadlock
+        locks = [self._symbol_lock(symbol) for symbol in symbols]
+        for lock in locks:
+            lock.acquire()
+        try:
+            stale = [symbol for symbol in symbols if not self.is_fresh(symbol)]
+            self.stats["hits"] += len(symbols) - len(stale)
+            if len(stale) == 0:
+                return
+            if len(stale) == 1:
+                self._refresh(stale[0])
+                return
+
+            cached = {}
+            for symbol in stale:
+                dataframe = self.bars.get(symbol)
+                cached[symbol] = dataframe if dataframe is not None else self._load(symbol)
+
+            if any(self._needs_seed(dataframe) for dataframe in cached.values()):
+                # at least one symbol needs seeding so pull the whole period for all of them
+                self.stats["seeds"] += 1
+                data = self._bulk_download(stale, period=self.period)
+            else:
+                self.stats["top_ups"] += 1
+                data = self._bulk_download(stale, start=min(dataframe.index[-1] for dataframe in cached.values()))
+
+            for symbol in stale:
+                new_bars = self._slice(data, symbol, len(stale))
+                dataframe = cached[symbol]
+                if self._needs_seed(dataframe):
+                    if new_bars is None:
+                        # yahoo didnt return this symbol, get() will try again on its own
+                        continue
+                    dataframe = new_bars
+                else:
+                    dataframe = self.merge(dataframe, new_bars)
+                self.put(symbol, dataframe)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def last_close(self, symbol: str) -> float:
+        """ Returns:
+                float: the close of the newest cached bar for the symbol, or None
+                    if nothing is cached, never downloads
+        """
+        dataframe = self.bars.get(symbol)
+        if dataframe is None or len(dataframe) == 0:
+            return None
+        return float(dataframe.Close.iloc[-1])
+
+    def put(self, symbol: str, dataframe: pd.DataFrame):
+        """ Stores the bars for a symbol and marks them as fresh
+
+        Args:
+            symbol: (str) the stock symbol
+            dataframe: (DataFrame) the bars, only the last max_bars are kept
+        """
+        dataframe = dataframe[COLUMNS].tail(self.max_bars)
+        self.bars[symbol] = dataframe
+        self.fetched_at[symbol] = time.time()
+        self._save(symbol, dataframe)
+
+    def is_fresh(self, symbol: str) -> bool:
+        """ Returns:
+                bool: True if the bars for the symbol are younger than max_age
+        """
+        fetched_at = self.fetched_at.get(symbol)
+        return fetched_at is not None and time.time() - fetched_at < self.max_age
+
+    def merge(self, dataframe: pd.DataFrame, new_bars: pd.DataFrame) -> pd.DataFrame:
+        """ merges newly downloaded bars into the cached ones, new bars win
+            where the timestamps overlap
+        """
+        if new_bars is None or len(new_bars) == 0:
+            return dataframe
+        merged = pd.concat([dataframe, new_bars[COLUMNS]])
+        merged = merged[~merged.index.duplicated(keep='last')]
+        return merged.sort_index()
+
+    def _refresh(self, symbol):
+        # must be called while holding the symbol lock
+        dataframe = self.bars.get(symbol)
+        if dataframe is None:
+            dataframe = self._load(symbol)
+
+        if self._needs_seed(dataframe):
+            # nothing (recent) cached yet, pull the whole period
+            self.stats["seeds"] += 1
+            dataframe = self._download(symbol, period=self.period)
+        else:
+            # the last bar is usually still forming so fetch it again
+            self.stats["top_ups"] += 1
+            new_bars = self._download(symbol, start=dataframe.index[-1])
+            dataframe = self.merge(dataframe, new_bars)
+
+        self.put(symbol, dataframe)
+        return dataframe
+
+    def _needs_seed(self, dataframe):
+        """ True if the bars cant just be topped up: there are none or the last
+            one is older than the seed period, a top up would then download
+            more than a seed (or nothing, yahoo only keeps 60 days of 15m bars)
+        """
+        if dataframe is None or len(dataframe) == 0:
+            return True
+        period = _period_delta(self.period)
+        if period is None:
+            return False
+        last = dataframe.index[-1]
+        return pd.Timestamp.now(tz=last.tz) - last > period
+
+    def _bulk_download(self, symbols, period=None, start=None):
+        kwargs = {"period": period} if start is None else {
+            "start": start,
+            "end": pd.Timestamp.now(tz=start.tz) + timedelta(days=1),
+        }
+        # same adjusted prices as Ticker.history so merged bars line up.
+        # yf.download (0.2.18) has no session argument, only Ticker does
+        return self.limiter.call(yf.download, tickers=symbols, interval=self.interval, group_by='ticker',
+                                 auto_adjust=True, ignore_tz=False, progress=False, **kwargs)
+
+    def _slice(self, data, symbol, count):
+        # yfinance only adds the ticker level to the columns for more than one ticker
+        if count > 1 and isinstance(data.columns, pd.MultiIndex):
+            if symbol not in data.columns.get_level_values(0):
+                return None
+            data = data[symbol]
+        # the bulk frame shares one index so drop the rows this symbol has no bar for
+        return data[COLUMNS].dropna(how='all')
+
+    def _download(self, symbol, period=None, start=None):
+        ticker = yf.Ticker(symbol, session=self.session)
+        if start is not None:
+            # yfinance wont return anything if start and end are the same bar
+            dataframe = self.limiter.call(ticker.history, start=start, end=pd.Timestamp.now(tz=start.tz) + timedelta(days=1), interval=self.interval)
+        else:
+            dataframe = self.limiter.call(ticker.history, period=period, interval=self.interval)
+        return dataframe[COLUMNS]
+
+    def _symbol_lock(self, symbol):
+        with self._lock:
+            if symbol not in self._symbol_locks:
+                self._symbol_locks[symbol] = threading.Lock()
+            return self._symbol_locks[symbol]
+
+    def _path(self, symbol):
+        return os.path.join(self.cache_dir, f"{symbol}_{self.interval}.pkl")
+
+    def _load(self, symbol):
+        if self.cache_dir is None or not os.path.exists(self._path(symbol)):
+            return None
+        try:
+            return pd.read_pickle(self._path(symbol))
+        except Exception as error:
+            logger.warning("could not load cached bars for %s: %s", symbol, error)
+            return None
+
+    def _save(self, symbol, dataframe):
+        if self.cache_dir is None:
+            return
+        try:
+            dataframe.to_pickle(self._path(symbol))
+        except Exception as error:
+            logger.warning("could not save bars for %s: %s", symbol, error)
+
+
+def _period_delta(period):
+    """the yfinance period as a timedelta, None for 'ytd', 'max' or anything unknown"""
+    for suffix, days in (('mo', 30), ('wk', 7), ('d', 1), ('y', 365)):
+        if period.endswith(suffix) and period[:-len(suffix)].isdigit():
+            return timedelta(days=int(period[:-len(suffix)]) * days)
+    return None
@@ -0,0 +1,59 @@
+import threading
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+class NewsBatch:
+    """ Shared between the workers handling one news item that is tagged with
+        several of our symbols, so the decisions for all of them are made with
+        one gpt call.
+
+        whichever worker gets there first makes the decisions for every symbol,
+        the other workers wait for it and then pick up their own decision.
+
+        usage example:
+            batch = NewsBatch(symbols=['AAPL', 'MSFT'], news=news)
+            decision = batch.decision('AAPL', trading_bot.make_batch_decisions)
+
+    Args:
+        symbols: (list) the symbols this news item is being processed for
+        news: (dict) the news item
+    """
+
+    def __init__(self, symbols, news):
+        self.symbols = symbols
+        self.news = news
+        self.decisions = None
+        self._lock = threading.Lock()
+
+    def decision(self, symbol, decide):
+        """ Returns the decision for the given symbol, making the decisions for
+            the whole batch if nobody has yet
+
+        Args:
+            symbol: (str) the symbol to get the decision for
+            decide: function called as decide(symbols, news) that returns a
+                dict of symbol: decision
+
+        Returns:
+            dict: the decision or None if the batch has no decision for the symbol,
+                see answered for why
+        """
+        with self._lock:
+            if self.decisions is None:
+                try:
+                    self.decisions = decide(self.symbols, self.news)
+                except Exception as error:
+                    # let each worker fall back to its own call
+                    logger.warning("batched decision failed: %s", error)
+                    self.decisions = {}
+            return self.decisions.get(symbol)
+
+    def answered(self, symbol) -> bool:
+        """ Returns:
+                bool: True if the batch was asked about the symbol, even if the
+                    answer (and the single symbol retry after it) was None, False
+                    if the symbol was left out or the batched call failed
+        """
+        with self._lock:
+            return self.decisions is not None and symbol in self.decisions
@@ -0,0 +1,280 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from selenium.common.exceptions import WebDriverException
+
+from core.easy_equities import EasyEquities
+from core.files import write_json
+from core.instrument_index import InstrumentIndex
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+BASE_URL = "https://platform.easyequities.co.za/"
+
+class BrowserPool:
+    """ A pool of logged in EasyEquities browsers so orders for different
+        symbols can run at the same time, one per browser.
+
+        the cookies of every browser are saved to disk, on startup they are
+        put back so the browser is still logged in and login() only has to
+        check that it is. a browser is checked again before it is handed out
+        if it hasnt been for a while, and replaced if it has died.
+
+        usage example:
+            pool = BrowserPool(lambda: webdriver.Chrome(), username, password, size=3, cookie_dir='cookies')
+            pool.start()
+            futures = [pool.buy_stock(symbol, 100) for symbol in ['AAPL', 'MSFT', 'TSLA']]
+            results = [future.result() for future in futures]
+            pool.close()
+
+    Args:
+        driver_factory: function that returns a new selenium webdriver
+        username: easy equities username
+        password: easy equities password
+        size: (int) how many browsers to run
+        cookie_dir: (str) optional folder to keep each browsers cookies in
+            between restarts
+        check_interval: (float) seconds a browser can go without being checked
+            before it is handed out
+        instrument_index_path: (str) optional json file shared by all the
+            browsers, see InstrumentIndex
+        **kwargs: passed on to EasyEquities (account, wait_timeout, holdings_ttl)
+    """
+
+    def __init__(self, driver_factory, username, password, size=2, cookie_dir=None, check_interval=300,
+                 instrument_index_path=None, **kwargs):
+        self.driver_factory = driver_factory
+        self.username = username
+        self.password = password
+        self.size = size
+        self.cookie_dir = cookie_dir
+        self.check_interval = check_interval
+        self.kwargs = kwargs
+        # every browser finds instruments for the others
+        self.instruments = InstrumentIndex(instrument_index_path)
+
+        if self.cookie_dir is not None:
+            os.makedirs(self.cookie_dir, exist_ok=True)
+
+        # slot: EasyEquities
+        self.sessions = {}
+        # slot: time.monotonic() it was last checked
+        self.checked_at = {}
+        self._free = queue.Queue()
+        self._executor = None
+        # symbol: Future of the last action queued for it, the next action for
+        # the symbol only goes to the executor once that one is done
+        self._chains = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "orders": 0,
+            "restored": 0,
+            "logins": 0,
+            "replaced": 0,
+        }
+
+    def start(self):
+        """ opens and logs in every browser, in parallel """
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            list(executor.map(self._open, range(self.size)))
+        for slot in range(self.size):
+            self._free.put(slot)
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="browser")
+
+    def close(self):
+        """ saves the cookies and closes every browser """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        for slot, session in self.sessions.items():
+            self._save_cookies(slot, session.driver)
+            try:
+                session.driver.quit()
+            except WebDriverException:
+                pass
+
+    @contextmanager
+    def session(self):
+        """ hands out a free, healthy browser for as long as the with block runs
+
+        usage example:
+            with pool.session() as easy_equities:
+                easy_equities.get_positions()
+        """
+        slot = self._free.get()
+        try:
+            yield self._checked(slot)
+        finally:
+            self._free.put(slot)
+
+    def run(self, action, symbol=None):
+        """ runs action(easy_equities) on the next free browser
+
+        Args:
+            action: function called with an EasyEquities
+            symbol: (str) optional, actions for the same symbol never run at
+                the same time
+
+        Returns:
+            Future: the result of action
+        """
+        def task():
+            with self.session() as easy_equities:
+                return action(easy_equities)
+
+        if symbol is None:
+            return self._executor.submit(task)
+
+        # actions for the same symbol wait their turn here instead of holding a
+        # worker thread the other symbols could be using
+        future = Future()
+        with self._lock:
+            previous = self._chains.get(symbol)
+            self._chains[symbol] = future
+        future.add_done_callback(lambda _: self._unchain(symbol, future))
+
+        def finished(submitted):
+            if submitted.exception() is not None:
+                future.set_exception(submitted.exception())
+            else:
+                future.set_result(submitted.result())
+
+        def start(_=None):
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                self._executor.submit(task).add_done_callback(finished)
+            except RuntimeError as error:
+                # the pool was closed while this was waiting
+                future.set_exception(error)
+
+        if previous is None:
+            start()
+        else:
+            previous.add_done_callback(start)
+        return future
+
+    def buy_stock(self, symbol, ammount):
+        """ EasyEquities.buy_stock on the next free browser
+
+        Returns:
+            Future: True if the stock was bought
+        """
+        def buy(easy_equities):
+            try:
+                return easy_equities.buy_stock(symbol, ammount)
+            finally:
+                self._count("orders")
+                # the other browsers holdings are out of date too
+                self._invalidate_holdings()
+
+        return self.run(buy, symbol=symbol)
+
+    def sell_position(self, symbol, percentage=100):
+        """ EasyEquities.sell_position on the next free browser
+
+        Returns:
+            Future: True if the position was sold
+        """
+        def sell(easy_equities):
+            try:
+                return easy_equities.sell_position(symbol, percentage)
+            finally:
+                self._count("orders")
+                self._invalidate_holdings(symbol if percentage >= 100 else None)
+
+        return self.run(sell, symbol=symbol)
+
+    def _open(self, slot):
+        driver = self.driver_factory()
+        session = EasyEquities(driver, self.username, self.password, **self.kwargs)
+        session.instruments = self.instruments
+        if self._restore_cookies(slot, driver):
+            self._count("restored")
+        # only fills in the form if the restored cookies didnt log us in
+        session.login()
+        self._count("logins")
+        self._save_cookies(slot, driver)
+        self.sessions[slot] = session
+        self.checked_at[slot] = time.monotonic()
+        return session
+
+    def _checked(self, slot):
+        """the browser in the slot, replaced if it has died and logged in
+        again if it hasnt been checked for a while"""
+        session = self.sessions[slot]
+        try:
+            # cheap, but fails if the browser has crashed or been closed
+            session.driver.current_url
+        except WebDriverException as error:
+            logger.warning("browser %d died, replacing it: %s", slot, error)
+            self._count("replaced")
+            try:
+                session.driver.quit()
+            except WebDriverException:
+                pass
+            return self._open(slot)
+
+        if time.monotonic() - self.checked_at[slot] > self.check_interval:
+            session.login()
+            self._save_cookies(slot, session.driver)
+            self.checked_at[slot] = time.monotonic()
+        return session
+
+    def _restore_cookies(self, slot, driver):
+        path = self._cookie_path(slot)
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            with open(path) as file:
+                cookies = json.load(file)
+            # cookies can only be added for the site the browser is on
+            driver.get(BASE_URL)
+            now = time.time()
+            for cookie in cookies:
+                if cookie.get("expiry") is not None and cookie["expiry"] < now:
+                    continue
+                driver.add_cookie(cookie)
+            return True
+        except Exception as error:
+            logger.warning("could not restore the cookies for browser %d: %s", slot, error)
+            return False
+
+    def _save_cookies(self, slot, driver):
+        path = self._cookie_path(slot)
+        if path is None:
+            return
+        try:
+            cookies = [
+                {key: cookie[key] for key in ("name", "value", "domain", "path", "secure", "httpOnly", "expiry") if key in cookie}
+                for cookie in driver.get_cookies()
+            ]
+            for cookie in cookies:
+                if "expiry" in cookie:
+                    cookie["expiry"] = int(cookie["expiry"])
+            write_json(path, cookies)
+        except Exception as error:
+            logger.warning("could not save the cookies for browser %d: %s", slot, error)
+
+    def _cookie_path(self, slot):
+        if self.cookie_dir is None:
+            return None
+        return os.path.join(self.cookie_dir, f"browser_{slot}.json")
+
+    def _invalidate_holdings(self, symbol=None):
+        for session in self.sessions.values():
+            session.invalidate_holdings(symbol)
+
+    def _unchain(self, symbol, future):
+        with self._lock:
+            if self._chains.get(symbol) is future:
+                del self._chains[symbol]
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
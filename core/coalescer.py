@@ -0,0 +1,129 @@
+import threading
+
+class NewsCoalescer:
+    """ Merges news that arrives close together for the same symbol into one
+        evaluation and makes sure only one evaluation per symbol is in flight.
+
+        news for a symbol waits `window` seconds for more news to join it before
+        it is handed to the dispatcher. if the symbol is still being processed
+        when the window closes the news waits as the one follow-up evaluation,
+        and anything else that arrives in the meantime joins that follow-up.
+        so during a news storm a symbol costs at most one running and one
+        waiting evaluation and no news is dropped.
+
+        usage example:
+            coalescer = NewsCoalescer(handler=trading_bot.process_stock, window=2)
+            dispatcher = NewsDispatcher(handler=coalescer.run, on_drop=coalescer.dropped)
+            coalescer.submit_job = dispatcher.submit
+            coalescer.submit('AAPL', news)
+
+    Args:
+        handler: function called as handler(symbol, news, batch=batch) where news
+            is a single news dict, or a list of them if several were merged
+        window: (float) seconds to wait for more news before evaluating,
+            0 evaluates straight away (only the single flight applies)
+    """
+
+    def __init__(self, handler, window=2):
+        self.handler = handler
+        self.window = window
+        # set to NewsDispatcher.submit (or anything with the same signature)
+        self.submit_job = None
+
+        # symbol: {"news": [], "batches": [], "ready": bool}
+        self._pending = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self.stats = {
+            "received": 0,
+            "merged": 0,
+            "evaluations": 0,
+        }
+
+    def submit(self, symbol, news, batch=None):
+        """ adds news for a symbol, can be called from any thread
+
+        Args:
+            symbol: (str) the symbol the news is for
+            news: (dict) the news item
+            batch: (NewsBatch) the batch the news belongs to if any
+        """
+        with self._lock:
+            self.stats["received"] += 1
+            group = self._pending.get(symbol)
+            if group is not None:
+                # join the evaluation that is already waiting
+                group["news"].append(news)
+                group["batches"].append(batch)
+                self.stats["merged"] += 1
+                return
+            self._pending[symbol] = {"news": [news], "batches": [batch], "ready": False}
+
+        if self.window > 0:
+            timer = threading.Timer(self.window, self._window_closed, args=(symbol,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._window_closed(symbol)
+
+    def run(self, symbol, news, batch=None):
+        """ the dispatchers handler, runs the evaluation and then lets the
+            follow-up (if there is one) through
+        """
+        try:
+            self.handler(symbol, news, batch=batch)
+        finally:
+            self._done(symbol)
+
+    def dropped(self, symbol, news, batch=None):
+        """ the dispatchers on_drop, a queued evaluation was thrown away so
+            the symbol is no longer in flight
+        """
+        self._done(symbol)
+
+    def pending(self):
+        """ Returns:
+                int: how many symbols have news waiting to be evaluated
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def _window_closed(self, symbol):
+        with self._lock:
+            group = self._pending.get(symbol)
+            if group is None:
+                return
+            group["ready"] = True
+            if symbol in self._in_flight:
+                # _done picks it up once the running evaluation finishes
+                return
+            del self._pending[symbol]
+            self._in_flight.add(symbol)
+        self._dispatch(symbol, group)
+
+    def _done(self, symbol):
+        with self._lock:
+            self._in_flight.discard(symbol)
+            group = self._pending.get(symbol)
+            if group is None or not group["ready"]:
+                return
+            del self._pending[symbol]
+            self._in_flight.add(symbol)
+        # dont queue from the worker thread, it could block on its own full queue
+        threading.Thread(target=self._dispatch, args=(symbol, group), daemon=True).start()
+
+    def _dispatch(self, symbol, group):
+        with self._lock:
+            self.stats["evaluations"] += 1
+
+        if len(group["news"]) == 1:
+            news, batch = group["news"][0], group["batches"][0]
+        else:
+            # merged news is evaluated on its own, the other symbols in any
+            # batch still get their batched decision
+            news, batch = group["news"], None
+
+        queued = self.submit_job(symbol, news, batch=batch)
+        if queued is False:
+            # dropped by the dispatcher, let the next news through
+            self._done(symbol)
@@ -0,0 +1,202 @@
+import json
+import math
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+class DecisionParseError(Exception):
+    """ raised when gpts answer cant be turned into a valid decision """
+
+
+class JsonObjectScanner:
+    """
+    Finds where the first top level JSON object in a stream of text ends, the
+    text can be fed in a piece at a time and every character is only looked at once.
+
+    Example:
+        scanner = JsonObjectScanner()
+        scanner.feed('ok {"buy": 1, "me')   # None
+        scanner.feed('ssage": "}"} bye')    # 29, the index just after the object
+    """
+    def __init__(self):
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.start = None
+        self.end = None
+        # index of the last comma directly inside the top level object, used
+        # to cut a truncated answer back to its last complete field
+        self.last_comma = None
+
+    def feed(self, text):
+        """Scans the next piece of text.
+
+        Returns:
+            int: the index (in all the text fed so far) just past the closing
+                brace of the first object, or None if it hasnt closed yet
+        """
+        if self.end is not None:
+            return self.end
+        for char in text:
+            self.position += 1
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif self.start is None:
+                if char == '{':
+                    self.start = self.position - 1
+                    self.depth = 1
+            elif char == '"':
+                self.in_string = True
+            elif char == '{' or char == '[':
+                self.depth += 1
+            elif char == '}' or char == ']':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = self.position
+                    return self.end
+            elif char == ',' and self.depth == 1:
+                self.last_comma = self.position - 1
+        return None
+
+
+def extract_json_object(text: str) -> dict:
+    """ Pulls the first JSON object out of gpts answer in a single pass, code
+        fences and any prose before or after the object are ignored. an answer
+        that was cut off by max_tokens is closed off so the complete fields
+        can still be used.
+
+    Args:
+        text: (str) the answer from gpt
+
+    Returns:
+        dict: the parsed object
+
+    Raises:
+        DecisionParseError: if there is no object or it cant be repaired
+    """
+    scanner = JsonObjectScanner()
+    end = scanner.feed(text)
+    if scanner.start is None:
+        raise DecisionParseError(f"no JSON object found in: {text!r}")
+
+    if end is not None:
+        candidates = [text[scanner.start:end]]
+    else:
+        # truncated, first try closing the open string and brackets as is
+        # and then try dropping the field that was cut off
+        body = text[scanner.start:].rstrip()
+        closed = body + ('"' if scanner.in_string else '') + '}' * scanner.depth
+        candidates = [closed]
+        if scanner.last_comma is not None:
+            candidates.append(text[scanner.start:scanner.last_comma] + '}')
+
+    for candidate in candidates:
+        try:
+            result = json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(result, dict):
+            return result
+    raise DecisionParseError(f"malformed JSON object in: {text!r}")
+
+
+@dataclass
+class Decision:
+    """
+    A validated trading decision.
+
+    Attributes:
+        buy: quantity of shares to buy or None
+        sell: True to close the position or None
+        trail_percent: percentage for the trailing stop loss, only needed when buying
+        message: optional feed back from gpt
+    """
+    buy: Optional[int] = None
+    sell: Optional[bool] = None
+    trail_percent: Optional[float] = None
+    message: str = ''
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Decision':
+        """ Validates a decision dict against the decision schema
+
+        Args:
+            data: (dict) {"buy": int or null, "sell": bool or null,
+                "trail_percent": float, "message": str}
+
+        Returns:
+            Decision
+
+        Raises:
+            DecisionParseError: if a field has the wrong type
+        """
+        if not isinstance(data, dict):
+            raise DecisionParseError(f"decision is not an object: {data!r}")
+        for key in ('buy', 'sell'):
+            if key not in data:
+                raise DecisionParseError(f"decision is missing {key}: {data!r}")
+
+        buy = data.get('buy')
+        if buy is not None:
+            # gpt sometimes answers 2.0 for 2 shares
+            # json.loads accepts NaN and Infinity, which int() cant convert
+            if (isinstance(buy, bool) or not isinstance(buy, (int, float)) or not math.isfinite(buy)
+                    or buy != int(buy) or buy < 0):
+                raise DecisionParseError(f"buy must be a whole number or null: {buy!r}")
+            buy = int(buy) or None
+
+        sell = data.get('sell')
+        if sell is not None and not isinstance(sell, bool):
+            raise DecisionParseError(f"sell must be true or null: {sell!r}")
+        sell = sell or None
+
+        trail_percent = data.get('trail_percent')
+        if trail_percent is not None:
+            if (isinstance(trail_percent, bool) or not isinstance(trail_percent, (int, float))
+                    or not math.isfinite(trail_percent)):
+                raise DecisionParseError(f"trail_percent must be a number: {trail_percent!r}")
+            trail_percent = float(trail_percent)
+        elif buy is not None:
+            raise DecisionParseError("trail_percent is needed when buying")
+
+        message = data.get('message') or ''
+        if not isinstance(message, str):
+            message = json.dumps(message)
+
+        return cls(buy=buy, sell=sell, trail_percent=trail_percent, message=message)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def parse_decision(text: str) -> Decision:
+    """ Parses gpts answer for a single symbol
+
+    Raises:
+        DecisionParseError: if the answer isnt a valid decision
+    """
+    return Decision.from_dict(extract_json_object(text))
+
+
+def parse_decisions(text: str) -> dict:
+    """ Parses gpts answer for several symbols, symbols whose decision is
+        malformed are left out instead of failing the whole answer
+
+    Returns:
+        dict: symbol: Decision
+
+    Raises:
+        DecisionParseError: if the answer doesnt contain an object at all
+    """
+    decisions = {}
+    for symbol, data in extract_json_object(text).items():
+        try:
+            decisions[symbol] = Decision.from_dict(data)
+        except DecisionParseError:
+            pass
+    return decisions
@@ -0,0 +1,171 @@
+import atexit
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from core.decision import Decision
+from core.files import write_json
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+class DecisionCache:
+    """ LRU + TTL cache of gpt decisions so news that alpaca sends again (with a
+        new updated_at but the same headline and summary) doesnt cost another
+        gpt call.
+
+        the key is made of the symbol, a hash of the normalised news text, the
+        position state and the last price rounded into a bucket, so the same
+        news is only answered from the cache while the market hasnt moved much.
+
+        usage example:
+            cache = DecisionCache(ttl=1800, path='decisions.json')
+            key = cache.key('AAPL', stock_info)
+            decision = cache.get(key)
+            if decision is None:
+                decision = ...
+                cache.put(key, decision)
+
+    Args:
+        max_size: (int) how many decisions to keep, the least recently used
+            ones are dropped first
+        ttl: (float) seconds a decision is valid for
+        price_bucket: (float) width of the price buckets in percent
+        path: (str) optional json file to keep the cache in across restarts
+        save_delay: (float) seconds after a put before the file is written, in
+            the background, so a burst of decisions is saved once and put
+            never waits on the disk
+    """
+
+    def __init__(self, max_size=1000, ttl=1800, price_bucket=0.5, path=None, save_delay=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.price_bucket = price_bucket
+        self.path = path
+        self.save_delay = save_delay
+
+        # key: (time.time() it was stored, Decision)
+        self.entries = OrderedDict()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+        }
+        self._lock = threading.Lock()
+        # only one write at a time, the timer and flush can overlap
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self._load()
+        if self.path is not None:
+            # whatever is still waiting to be written
+            atexit.register(self.flush)
+
+    def key(self, symbol: str, stock_info: dict) -> str:
+        """ Builds the cache key for a symbol
+
+        Args:
+            symbol: (str) the stock symbol
+            stock_info: (dict) as described in GPTBot.make_trading_decision
+
+        Returns:
+            str: the key
+        """
+        news = self._news_hash(stock_info.get('news'))
+        position = f"{stock_info['open_position']}:{stock_info.get('opening_price')}"
+        return f"{symbol}|{news}|{position}|{self._price_bucket(stock_info)}"
+
+    def get(self, key: str) -> Decision:
+        """ Returns:
+                Decision: the cached decision or None if there isnt a valid one
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            stored_at, decision = entry
+            if time.time() - stored_at > self.ttl:
+                del self.entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return decision
+
+    def put(self, key: str, decision: Decision):
+        """ stores a decision, dropping the least recently used one if full """
+        with self._lock:
+            self.entries[key] = (time.time(), decision)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            if self.path is None or self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        """ writes the cache to path now if anything changed since the last write """
+        with self._lock:
+            if self._save_timer is None:
+                return
+            self._save_timer.cancel()
+            self._save_timer = None
+            data = {key: [stored_at, decision.to_dict()] for key, (stored_at, decision) in self.entries.items()}
+        with self._save_lock:
+            try:
+                write_json(self.path, data)
+            except Exception as error:
+                logger.warning("could not save the decision cache: %s", error)
+
+    def _news_hash(self, news):
+        """hashes the headline and summary only, with case, punctuation and
+        spacing normalised so small edits dont count as new news"""
+        if news is None:
+            return None
+        try:
+            items = json.loads(news) if isinstance(news, str) else news
+        except json.JSONDecodeError:
+            items = news
+        if isinstance(items, dict):
+            items = [items]
+        if isinstance(items, list):
+            text = ' '.join(f"{item.get('headline', '')} {item.get('summary', '')}" for item in items if isinstance(item, dict))
+        else:
+            text = str(items)
+        text = ' '.join(re.sub(r'[^a-z0-9]+', ' ', text.lower()).split())
+        return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+    def _price_bucket(self, stock_info):
+        bars = stock_info.get('bars')
+        if bars is not None and len(bars) > 0:
+            price = float(bars['Close'].iloc[-1])
+        elif stock_info.get('current_price') is not None:
+            price = float(stock_info['current_price'])
+        else:
+            price_history = stock_info.get('price_history')
+            price = float(price_history[-1]) if price_history is not None and len(price_history) > 0 else 0.0
+        if price <= 0:
+            return None
+        # buckets are a fixed percentage wide whatever the price
+        return math.floor(math.log(price) / math.log1p(self.price_bucket / 100))
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            now = time.time()
+            for key, (stored_at, decision) in data.items():
+                if now - stored_at <= self.ttl:
+                    self.entries[key] = (stored_at, Decision.from_dict(decision))
+        except Exception as error:
+            logger.warning("could not load the decision cache: %s", error)
@@ -0,0 +1,255 @@
+import asyncio
+import queue
+import threading
+import zlib
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+# what to do when a symbols queue is full
+BLOCK = 'block'
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+
+class NewsDispatcher:
+    """ Bounded queue + worker pool that sits between News and TradingBot so
+        the websocket thread never has to wait on yfinance, gpt or alpaca.
+
+        every symbol is pinned to one worker (by hashing the symbol), so news
+        for the same symbol is processed in the order it arrived while
+        different symbols are processed in parallel.
+
+        usage example:
+            dispatcher = NewsDispatcher(handler=trading_bot.process_stock, workers=4)
+            dispatcher.start()
+            dispatcher.submit('AAPL', news)
+
+    Args:
+        handler: function called as handler(symbol, *args, **kwargs) for every job
+        workers: (int) how many workers to run
+        max_queue: (int) max number of jobs waiting per worker
+        mode: (str) 'thread' to run each worker in its own thread or 'asyncio'
+            to run the workers on an event loop, blocking handlers are run in
+            a thread pool and coroutine handlers are awaited directly
+        backpressure: (str) what to do when a queue is full
+            'block': wait for space (up to block_timeout seconds, then drop)
+            'drop_newest': drop the job being submitted
+            'drop_oldest': drop the oldest waiting job to make space
+        block_timeout: (float) max seconds to block for, None waits forever
+        on_drop: optional function called as on_drop(symbol, *args, **kwargs)
+            for a job that was already queued and then dropped by 'drop_oldest',
+            jobs dropped on submit are reported by submit returning False
+    """
+
+    def __init__(self, handler, workers=4, max_queue=100, mode='thread', backpressure=BLOCK, block_timeout=None, on_drop=None):
+        if mode not in ('thread', 'asyncio'):
+            raise Exception(f"unknown dispatcher mode {mode}")
+        if backpressure not in (BLOCK, DROP_NEWEST, DROP_OLDEST):
+            raise Exception(f"unknown backpressure policy {backpressure}")
+
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.mode = mode
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self.on_drop = on_drop
+
+        self.stats = {
+            "submitted": 0,
+            "processed": 0,
+            "failed": 0,
+            "dropped": 0,
+        }
+        self._stats_lock = threading.Lock()
+        self._queues = []
+        self._threads = []
+        self._loop = None
+        self._running = False
+
+    def start(self):
+        """ starts the workers, jobs can only be submitted after this is called """
+        if self._running:
+            return
+        self._running = True
+
+        if self.mode == 'thread':
+            self._queues = [queue.Queue(maxsize=self.max_queue) for _ in range(self.workers)]
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._thread_worker, args=(self._queues[index],), name=f"news-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        else:
+            self._loop = asyncio.new_event_loop()
+            started = threading.Event()
+            thread = threading.Thread(target=self._run_loop, args=(started,), name="news-loop", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+            started.wait()
+
+    def stop(self, wait=True):
+        """ stops the workers once the jobs already in the queues are done
+
+        Args:
+            wait: (bool) block until the workers have finished
+        """
+        if not self._running:
+            return
+        self._running = False
+
+        if self.mode == 'thread':
+            for _queue in self._queues:
+                # the sentinel must get through even if the queue is full
+                _queue.put(None)
+        else:
+            for _queue in self._queues:
+                asyncio.run_coroutine_threadsafe(_queue.put(None), self._loop)
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def submit(self, symbol, *args, **kwargs):
+        """ queues a job for the given symbol, can be called from any thread
+
+        Args:
+            symbol: (str) the symbol the job belongs to, jobs with the same symbol
+                are run one at a time in the order they were submitted
+            *args: passed on to the handler after the symbol
+            **kwargs: passed on to the handler as keyword arguments
+
+        Returns:
+            bool: True if the job was queued, False if it was dropped
+        """
+        if not self._running:
+            raise Exception("dispatcher has not been started")
+
+        self._count("submitted")
+        job = (symbol, args, kwargs)
+        _queue = self._queues[self._shard(symbol)]
+
+        if self.mode == 'thread':
+            queued = self._put(_queue, job)
+        else:
+            future = asyncio.run_coroutine_threadsafe(self._async_put(_queue, job), self._loop)
+            queued = future.result()
+
+        if not queued:
+            logger.warning("news queue full, dropped job for %s", symbol)
+        return queued
+
+    def qsize(self):
+        """ Returns:
+                int: how many jobs are waiting across all workers
+        """
+        return sum(_queue.qsize() for _queue in self._queues)
+
+    def _shard(self, symbol):
+        # crc32 is stable across runs unlike hash()
+        return zlib.crc32(symbol.encode()) % self.workers
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _put(self, _queue, job):
+        if self.backpressure == BLOCK:
+            try:
+                _queue.put(job, timeout=self.block_timeout)
+                return True
+            except queue.Full:
+                self._count("dropped")
+                return False
+
+        while True:
+            try:
+                _queue.put_nowait(job)
+                return True
+            except queue.Full:
+                if self.backpressure == DROP_NEWEST:
+                    self._count("dropped")
+                    return False
+                # DROP_OLDEST, make space and try again
+                try:
+                    evicted = _queue.get_nowait()
+                    _queue.task_done()
+                    self._evicted(evicted)
+                except queue.Empty:
+                    pass
+
+    async def _async_put(self, _queue, job):
+        if self.backpressure == BLOCK:
+            try:
+                await asyncio.wait_for(_queue.put(job), timeout=self.block_timeout)
+                return True
+            except asyncio.TimeoutError:
+                self._count("dropped")
+                return False
+
+        if _queue.full():
+            if self.backpressure == DROP_NEWEST:
+                self._count("dropped")
+                return False
+            evicted = _queue.get_nowait()
+            _queue.task_done()
+            self._evicted(evicted)
+        _queue.put_nowait(job)
+        return True
+
+    def _evicted(self, job):
+        self._count("dropped")
+        if job is None or self.on_drop is None:
+            return
+        symbol, args, kwargs = job
+        logger.warning("news queue full, dropped oldest job for %s", symbol)
+        try:
+            self.on_drop(symbol, *args, **kwargs)
+        except Exception as error:
+            logger.exception("on_drop failed for %s: %s", symbol, error)
+
+    def _run(self, symbol, args, kwargs):
+        try:
+            self.handler(symbol, *args, **kwargs)
+            self._count("processed")
+        except Exception as error:
+            # one bad job shouldnt take the worker down with it
+            self._count("failed")
+            logger.exception("problem processing %s: %s", symbol, error)
+
+    def _thread_worker(self, _queue):
+        while True:
+            job = _queue.get()
+            try:
+                if job is None:
+                    return
+                self._run(*job)
+            finally:
+                _queue.task_done()
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._queues = [asyncio.Queue(maxsize=self.max_queue) for _ in range(self.workers)]
+        tasks = [self._loop.create_task(self._async_worker(_queue)) for _queue in self._queues]
+        self._loop.call_soon(started.set)
+        self._loop.run_until_complete(asyncio.gather(*tasks))
+        self._loop.close()
+
+    async def _async_worker(self, _queue):
+        while True:
+            job = await _queue.get()
+            try:
+                if job is None:
+                    return
+                symbol, args, kwargs = job
+                if asyncio.iscoroutinefunction(self.handler):
+                    try:
+                        await self.handler(symbol, *args, **kwargs)
+                        self._count("processed")
+                    except Exception as error:
+                        self._count("failed")
+                        logger.exception("problem processing %s: %s", symbol, error)
+                else:
+                    await self._loop.run_in_executor(None, self._run, symbol, args, kwargs)
+            finally:
+                _queue.task_done()
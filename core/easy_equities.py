@@ -5,7 +5,54 @@ from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, TimeoutException
+from core.instrument_index import InstrumentIndex
+from core.log import get_logger
+from core.waits import Waiter
+
+logger = get_logger(__name__)
+
+# reads the whole holdings table in one go, one webdriver call no matter how
+# many holdings there are instead of a few per row
+HOLDINGS_SCRIPT = """
+return Array.prototype.map.call(document.querySelectorAll('.holding-table-body .table-display'), function (row) {
+    var links = row.querySelectorAll('.actions-cell a');
+    var text = function (selector) {
+        var cell = row.querySelector(selector);
+        return cell ? cell.textContent : null;
+    };
+    return {
+        row: row,
+        sell_url: links.length > 0 ? links[0].href : null,
+        buy_more_url: links.length > 1 ? links[1].href : null,
+        purchase_value: text('.purchase-value-cell'),
+        current_value: text('.current-value-cell'),
+    };
+});
+"""
+
+class Holding:
+    """ An open position on easy equities as shown in the holdings table
+
+    Args:
+        symbol: the stock symbol
+        purchase_amount: (float) how much was paid for the position
+        current_amount: (float) what the position is worth now, None if the
+            holdings table didnt show it
+        sell_url: (str) the link behind the rows sell button
+        row: the webdriver element of the row in the holdings table
+    """
+    __slots__ = ('symbol', 'purchase_amount', 'current_amount', 'sell_url', 'row')
+
+    def __init__(self, symbol, purchase_amount, current_amount, sell_url=None, row=None):
+        self.symbol = symbol
+        self.purchase_amount = purchase_amount
+        self.current_amount = current_amount
+        self.sell_url = sell_url
+        self.row = row
+
+    def __repr__(self):
+        return f"Holding({self.symbol}, purchase_amount={self.purchase_amount}, current_amount={self.current_amount})"
 
 class EasyEquities:
     """A selenium based browser contorller to buy, sell, manage stocks on easy equities
@@ -13,13 +60,32 @@ class EasyEquities:
     Args:
         driver: a selenium webdriver
         account: the type of account inside easy equities, default is 'Demo USD'
+        wait_timeout: how long to wait for the page before giving up, the waits
+            return as soon as the page is ready (see core.waits), how long they
+            took is kept in self.waiter.timings
+        instrument_index_path: optional json file to remember the instrument page of
+            every symbol in, so buys can skip the search (see InstrumentIndex)
+        holdings_ttl: seconds get_positions answers from the last holdings it read
+            instead of loading the holdings page again, our own buys and sells
+            update it straight away
     """
-    def __init__(self, driver, username, password, account = 'Demo USD'):
+    def __init__(self, driver, username, password, account = 'Demo USD', wait_timeout=10, instrument_index_path=None, holdings_ttl=60):
         self.driver = driver
         self.account = account
-        self.driver.implicitly_wait(10)
+        # the waits poll for themselves, an implicit wait would make every
+        # find_elements that comes back empty take the full 10 seconds
+        self.driver.implicitly_wait(0)
         self.username = username
         self.password = password
+        self.wait_timeout = wait_timeout
+        self.waiter = Waiter(driver, timeout=wait_timeout)
+        self.instruments = InstrumentIndex(instrument_index_path)
+        # the account type sticks for the rest of the session once picked
+        self.account_loaded = False
+        # the last holdings read from the holdings page and when (time.monotonic)
+        self.holdings_ttl = holdings_ttl
+        self.holdings = None
+        self.holdings_at = None
 
     def login(self):
         """Directs the webdriver to the login page and logs in
@@ -51,6 +117,8 @@ class EasyEquities:
             password.send_keys(self.password)
             button = self.get_element((By.CSS_SELECTOR,'.login-form-container #SignIn'))
             button.click()
+            # a new session starts on the default account
+            self.account_loaded = False
             self.wait_for((By.CSS_SELECTOR, "#myProfileNavBar"))
             return True
         else:
@@ -67,7 +135,9 @@ class EasyEquities:
         self.wait_for(xpath)
         button = self.get_element(xpath)
         button.click()
-        time.sleep(3)
+        # the account is switched with ajax
+        self.network_idle()
+        self.account_loaded = True
         return
 
     def prep_stock_search(self):
@@ -92,7 +162,7 @@ class EasyEquities:
         """searches for a stock symbol
 
         Note: you need to call prep_stock_search befor calling this function or else if will break
-            use buy_stock instead
+            use open_instrument or buy_stock instead
 
         Args:
             string: the symbol you want to load
@@ -105,10 +175,9 @@ class EasyEquities:
             Bool: true if the symbol was found, false if not
         """
         xpath = (By.XPATH, "//input[@id='InstrumentSearchString']")
+        results_container = (By.XPATH, "//div[@id='stockContainer']")
         search_box = self.wait_and_get_element(xpath)
-        search_box.clear()
-        search_box.send_keys(symbol)
-        time.sleep(3)
+        self.wait_for_update(results_container, lambda: (search_box.clear(), search_box.send_keys(symbol)))
         results = self.get_elements((By.XPATH, f"//div[@id='stockContainer']//a"))
         target_elem = None
 
@@ -133,19 +202,52 @@ class EasyEquities:
                 and self.get_element((By.XPATH, "//div[@class='pagination']//a[contains(text(), '»')]"))
                 ):
                 # go to next page
-                self.get_element((By.XPATH, "//div[@class='pagination']//a[contains(text(), '»')]")).click()
+                next_page = self.get_element((By.XPATH, "//div[@class='pagination']//a[contains(text(), '»')]"))
                 # wait for items to load, they are loaded via javascript so we cant wait for
-                # an element to appear because its already there.
-                time.sleep(3)
+                # an element to appear because its already there, wait for them to change instead
+                self.wait_for_update(results_container, next_page.click)
+                results = self.get_elements((By.XPATH, f"//div[@id='stockContainer']//a"))
+            else:
+                # last page and the symbol wasnt on it
+                break
 
         # go to the stock page
         if target_elem is not None:
+            # next time we can go straight there
+            self.instruments.put(symbol, target_elem.get_attribute("href"))
             target_elem.click()
             return True
         else:
             return False
         
     
+    def open_instrument(self, symbol):
+        """goes to the stock page, straight to it if the url is in the instrument
+        index and by searching for it if not (or if the url no longer works)
+
+        Args:
+            symbol: the symbol you want to load
+
+        Returns:
+            Bool: true if the stock page was loaded, false if the symbol wasnt found
+        """
+        url = self.instruments.get(symbol)
+        if url is not None:
+            if not self.account_loaded:
+                self.prep_stock_search()
+            self.driver.get(url)
+            try:
+                self.waiter.visible((By.CSS_SELECTOR, '#js-value-amount'), timeout=5)
+                if symbol.lower() in self.driver.current_url.lower().split("."):
+                    return True
+            except TimeoutException:
+                pass
+            logger.info("instrument page for %s has moved, searching for it again", symbol)
+            self.instruments.drop(symbol)
+
+        self.prep_stock_search()
+        return self.load_stock(symbol)
+
     def buy_stock(self, symbol, ammount):
         """Buys a stock
 
@@ -153,8 +255,7 @@ class EasyEquities:
             symbol: The symbol of the stock to buy.
             ammount: how much money you want to spend
         """
-        self.prep_stock_search()
-        is_stock_loaded = self.load_stock(symbol)
+        is_stock_loaded = self.open_instrument(symbol)
         if is_stock_loaded:
             # wait for ammount input to appear
             money_input = self.wait_and_get_element((By.CSS_SELECTOR, '#js-value-amount'))
@@ -163,12 +264,18 @@ class EasyEquities:
                 money_input.clear()
                 money_input.send_keys(ammount)
                 money_input.send_keys(Keys.ENTER)
-                time.sleep(5)
-                button = self.get_element((By.CSS_SELECTOR,".trade-action-container__right-action-button div"))
+                # the quote is recalculated with ajax before the button can be used
+                self.network_idle()
+                try:
+                    button = self.waiter.clickable((By.CSS_SELECTOR,".trade-action-container__right-action-button div"))
+                except TimeoutException:
+                    button = False
                 if button:
                     # click buy button and wait for Congratulations page
                     # button.click()
                     # self.wait_for((By.XPATH, "//div[@class='js-quote']/div[contains(@class, 'value-allocations__quote')]"))
+                    # the holdings change once the order goes through
+                    self.invalidate_holdings()
                     button.click()
                     self.wait_for((By.XPATH, "//h1[text()='Congratulations']"))
                     return True
@@ -179,52 +286,86 @@ class EasyEquities:
         else:
             return False
         
-    def get_positions(self):
-        """Gets all the open positions
+    def get_positions(self, refresh=False):
+        """Gets all the open positions, from the last holdings read if they are
+        less than holdings_ttl seconds old
 
         Note: this does not get any pending positions
 
+        Args:
+            refresh: load the holdings page even if the last read is still fresh
+
         Returns:
-            dict:
-                symbol:
-                    purchase_amount: float
-                    current_amount: float
-                    item: webdriver element
+            dict: symbol: Holding
         Raises:
             Exception: would only raise an exception if the html changed
         """
+        # read once, another thread can invalidate it between the check and the copy
+        holdings = self.holdings
+        if not refresh and holdings is not None and self.holdings_fresh():
+            return dict(holdings)
+
         self.driver.get("https://platform.easyequities.co.za/AccountOverview")
         self.load_account_type()
-        time.sleep(3)
-        button = self.wait_and_get_element((By.CSS_SELECTOR, '#loadHoldings'))
+        button = self.waiter.clickable((By.CSS_SELECTOR, '#loadHoldings'))
         button.click()
 
         try: 
             self.wait_for((By.CSS_SELECTOR, ".holding-table-body .table-display"))
         except Exception as e:
-            print(e)
+            logger.debug(e)
             if self.get_element((By.CSS_SELECTOR,'#no-holdings-message')):
-                print('no open postitions')
+                logger.info('no open postitions')
+                self._store_holdings({})
                 return {}
 
-        items = self.get_elements((By.CSS_SELECTOR, ".holding-table-body .table-display"))
         postitions = {}
-        for item in items:
+        for row in self.driver.execute_script(HOLDINGS_SCRIPT):
             try:
-                buy_more_link = item.find_element(By.XPATH, ".//div[@class='actions-cell']//a[2]")
-                symbol = self.get_symbol_from_link(buy_more_link.get_attribute("href"))
-                purchase_amount = item.find_element(By.XPATH, ".//div[@class='purchase-value-cell']").text
-                purchase_amount = self.string_to_float(purchase_amount)
-                current_amount = item.find_element(By.XPATH, ".//div[@class='purchase-value-cell']").text
-                current_amount = self.string_to_float(current_amount)
-                postitions[symbol] = {
-                    "purchase_amount": purchase_amount,
-                    "current_amount": current_amount,
-                    "item": item,
-                }
+                symbol = self.get_symbol_from_link(row["buy_more_url"])
+                # selling only needs the link, a missing value cell shouldnt stop it
+                current_amount = None
+                if row["current_value"] is not None:
+                    current_amount = self.string_to_float(row["current_value"])
+                else:
+                    logger.warning("no current value for %s in the holdings table", symbol)
+                postitions[symbol] = Holding(
+                    symbol=symbol,
+                    purchase_amount=self.string_to_float(row["purchase_value"]),
+                    current_amount=current_amount,
+                    sell_url=row["sell_url"],
+                    row=row["row"],
+                )
             except Exception as e:
-                raise Exception(e)
-        return postitions
+                raise Exception(f"could not read holding {row}: {e}")
+        self._store_holdings(postitions)
+        return dict(postitions)
+
+    def holdings_fresh(self):
+        """
+        Returns:
+            bool: True if the last holdings read can still be used
+        """
+        return self.holdings is not None and time.monotonic() - self.holdings_at < self.holdings_ttl
+
+    def invalidate_holdings(self, symbol=None):
+        """Forgets the last holdings read, or only the given symbol so the other
+        holdings can still be used
+
+        Args:
+            symbol: the symbol to forget, everything if None
+        """
+        # may be called from another thread (see BrowserPool) while this one is
+        # copying the holdings, so swap in a new dict instead of changing it
+        holdings = self.holdings
+        if symbol is None or holdings is None:
+            self.holdings = None
+        else:
+            self.holdings = {key: holding for key, holding in holdings.items() if key != symbol}
+
+    def _store_holdings(self, holdings):
+        self.holdings = dict(holdings)
+        self.holdings_at = time.monotonic()
 
     def get_position(self, symbol):
         """gets a single open postition
@@ -233,10 +374,7 @@ class EasyEquities:
             symbol: The symbol of the stock to buy.
 
         Returns:
-            dict:
-                purchase_amount: float
-                current_amount: float
-                item: webdriver element
+            Holding: the position or None if there isnt one
         """
         postitions = self.get_positions()
         return postitions.get(symbol, None)
@@ -245,6 +383,9 @@ class EasyEquities:
     def sell_position(self, symbol, percentage=100):
         """Sells an open position
 
+        Selling several positions in a row only loads the holdings page once, the
+        later sells go straight to the sell link of the holding
+
         Args:
             symbol: The symbol of the stock to sell.
 
@@ -254,7 +395,12 @@ class EasyEquities:
 
         position = self.get_position(symbol)
         if position is not None:
-            position['item'].find_element(By.XPATH, ".//div[@class='actions-cell']//a[1]").click()
+            self.open_sell_page(position)
+            # whatever happens next the holding wont look the same
+            if percentage >= 100:
+                self.invalidate_holdings(symbol)
+            else:
+                self.invalidate_holdings()
             sell_percentage_input = self.wait_and_get_element((By.XPATH, "//input[@name='TradePercentage']"))
             sell_percentage_input.clear()
             sell_percentage_input.send_keys(percentage)
@@ -262,24 +408,49 @@ class EasyEquities:
 
             # some times selling does not go very smoothly so the proccess needs to be
             # repeated until easy equities allows us to click the sell button
-            i = 0
-            while(not self.get_element((By.XPATH, "//h1[text()='Success']"))):
-                i += 1
+            success = (By.XPATH, "//h1[text()='Success']")
+            for attempt in range(3):
+                if self.get_element(success):
+                    return True
                 try:
-                    print('attemping click')
-                    time.sleep(3)
+                    logger.debug('attemping click')
+                    self.network_idle()
                     sell_percentage_input.clear()
                     sell_percentage_input.send_keys(percentage)
                     sell_percentage_input.send_keys(Keys.ENTER)
-                    time.sleep(5)
-                    sell_button = self.get_element((By.CSS_SELECTOR, '.value-allocations__trade-button'))
+                    # the sell value is recalculated with ajax before the button can be used
+                    self.network_idle()
+                    sell_button = self.waiter.clickable((By.CSS_SELECTOR, '.value-allocations__trade-button'))
                     sell_button.click()
-                except:
-                    print('click failed')
-                    if i >= 3:
-                        return False
-            
-            return True
+                    self.waiter.visible(success, timeout=self.wait_timeout)
+                    return True
+                except Exception:
+                    logger.warning('click failed')
+
+            # the position is probably still there
+            self.invalidate_holdings()
+            return False
+
+    def open_sell_page(self, position):
+        """Opens the sell page for a holding, by clicking its row if the holdings
+        page is still showing or else by going to its sell link
+
+        Args:
+            position: the Holding to sell
+        """
+        try:
+            position.row.find_element(By.XPATH, ".//div[@class='actions-cell']//a[1]").click()
+            return
+        except (StaleElementReferenceException, NoSuchElementException):
+            # we have left the holdings page since it was read
+            pass
+        if position.sell_url and not position.sell_url.startswith('javascript'):
+            self.driver.get(position.sell_url)
+            return
+        position = self.get_positions(refresh=True).get(position.symbol)
+        if position is None:
+            raise Exception("position does not exist")
+        position.row.find_element(By.XPATH, ".//div[@class='actions-cell']//a[1]").click()
 
     def get_balance(self):
         """Gets how much money is available
@@ -315,6 +486,40 @@ class EasyEquities:
         """
         return link.split(".")[-1].upper()
 
+    def network_idle(self, timeout=None):
+        """Waits for the page to stop loading, pages that keep polling the server
+        never go quiet so running out of time isnt an error, the caller still
+        waits for the element it needs
+
+        Returns:
+            bool: True if the page went quiet, False if the wait timed out
+        """
+        try:
+            self.waiter.network_idle(timeout=timeout)
+            return True
+        except TimeoutException:
+            logger.debug("page still busy after waiting for it to go quiet")
+            return False
+
+    def wait_for_update(self, by_selector, action, timeout=5):
+        """Runs action (eg typing in a search box) and waits for the element
+        it updates with javascript to change and then stop changing
+
+        Args:
+            by_selector: the element that gets updated
+            action: function that triggers the update
+            timeout: how long to wait for the element to change, if it doesnt
+                (eg the same results came back) it only waits for it to settle
+        """
+        element = self.get_element(by_selector)
+        old_text = element.text if element else None
+        action()
+        try:
+            self.waiter.text_changed(by_selector, old_text, timeout=timeout)
+        except TimeoutException:
+            pass
+        self.waiter.stable(by_selector)
+
     def wait_and_get_element(self, by_selector):
         """Waits for the element to load then returns it
 
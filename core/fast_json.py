@@ -0,0 +1,17 @@
+import json
+
+try:
+    # orjson is optional, its several times faster than the standard library
+    import orjson
+
+    def loads(data):
+        """ parses JSON from str or bytes (orjson) """
+        return orjson.loads(data)
+
+    DECODER = 'orjson'
+except ImportError:
+    def loads(data):
+        """ parses JSON from str or bytes (standard library json) """
+        return json.loads(data)
+
+    DECODER = 'json'
@@ -0,0 +1,109 @@
+import numpy as np
+
+try:
+    import tiktoken
+    _encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+except Exception:
+    # tiktoken is optional, fall back to the ~4 characters per token rule of thumb
+    _encoding = None
+
+# bars to look back for each return, with 15 min bars: 15m, 1h, 1d, 5d
+HORIZONS = {"15m": 1, "1h": 4, "1d": 26, "5d": 130}
+SPARKLINE_POINTS = 16
+
+RAW = 'raw'
+COMPACT = 'compact'
+
+def compute_features(dataframe) -> dict:
+    """ Summarises a bar frame into a handful of numbers for the prompt,
+        everything is computed with numpy in one pass over the columns
+
+    Args:
+        dataframe: (DataFrame) bars with Close, High, Low and Volume columns
+
+    Returns:
+        dict:
+            last: (float) last close
+            returns: (dict) horizon: % return over that horizon
+            volatility: (float) std of the bar to bar % returns
+            vwap_distance: (float) % distance of the last close from the vwap
+            volume_z: (float) z-score of the last bars volume
+            sparkline: (list) closes downsampled to SPARKLINE_POINTS points
+    """
+    close = dataframe['Close'].to_numpy(dtype=float)
+    high = dataframe['High'].to_numpy(dtype=float)
+    low = dataframe['Low'].to_numpy(dtype=float)
+    volume = dataframe['Volume'].to_numpy(dtype=float)
+
+    if len(close) == 0:
+        return {}
+
+    last = close[-1]
+
+    returns = {}
+    for name, bars in HORIZONS.items():
+        # use the oldest bar we have if the history is shorter than the horizon
+        base = close[max(len(close) - 1 - bars, 0)]
+        returns[name] = (last / base - 1) * 100 if base else 0.0
+
+    bar_returns = np.diff(close) / close[:-1] * 100 if len(close) > 1 else np.zeros(1)
+    volatility = float(np.std(bar_returns))
+
+    typical = (high + low + close) / 3
+    total_volume = volume.sum()
+    vwap = (typical * volume).sum() / total_volume if total_volume else last
+    vwap_distance = (last / vwap - 1) * 100 if vwap else 0.0
+
+    volume_std = volume.std()
+    volume_z = (volume[-1] - volume.mean()) / volume_std if volume_std else 0.0
+
+    # pick evenly spaced bars (always including the last one)
+    indexes = np.linspace(0, len(close) - 1, num=min(SPARKLINE_POINTS, len(close))).round().astype(int)
+    sparkline = close[indexes]
+
+    return {
+        "last": float(last),
+        "returns": {name: float(value) for name, value in returns.items()},
+        "volatility": volatility,
+        "vwap_distance": float(vwap_distance),
+        "volume_z": float(volume_z),
+        "sparkline": [float(value) for value in sparkline],
+    }
+
+def format_features(features: dict) -> str:
+    """ Returns:
+            str: the features as a short single line for the prompt
+    """
+    if not features:
+        return "no price data"
+    returns = ' '.join(f"{name}:{value:+.2f}%" for name, value in features['returns'].items())
+    sparkline = ','.join(f"{value:.2f}" for value in features['sparkline'])
+    return (f"last {features['last']:.2f} | returns {returns} | volatility {features['volatility']:.2f}%"
+            f" | vwap distance {features['vwap_distance']:+.2f}% | volume z {features['volume_z']:+.1f}"
+            f" | sparkline(old to new) {sparkline}")
+
+def encode_price_history(dataframe, encoding=COMPACT) -> str:
+    """ Encodes the bars for the prompt
+
+    Args:
+        dataframe: (DataFrame) the bars
+        encoding: (str) 'raw' for every close price (the original behaviour)
+            or 'compact' for the feature summary
+
+    Returns:
+        str: the encoded price history
+    """
+    if encoding == RAW:
+        return str(dataframe['Close'].values)
+    if encoding == COMPACT:
+        return format_features(compute_features(dataframe))
+    raise Exception(f"unknown price encoding {encoding}")
+
+def count_tokens(text: str) -> int:
+    """ Returns:
+            int: how many gpt tokens the text is, exact if tiktoken is installed
+                otherwise an estimate
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return (len(text) + 3) // 4
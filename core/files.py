@@ -0,0 +1,14 @@
+import json
+import os
+
+def write_json(path, data):
+    """ writes data to path as json, to a temp file first and then moved into
+        place so a crash cant leave half a file
+
+    Raises:
+        OSError: if the file cant be written
+        TypeError: if data cant be turned into json
+    """
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file)
+    os.replace(path + '.tmp', path)
@@ -1,5 +1,11 @@
-import json
+import threading
 import openai
+from core.features import encode_price_history, count_tokens, RAW, COMPACT
+from core.decision import DecisionParseError, JsonObjectScanner, parse_decision, parse_decisions
+from core.log import get_logger
+from core.ratelimit import get_limiter
+
+logger = get_logger(__name__)
 
 class GPTBot:
     """
@@ -23,8 +29,55 @@ class GPTBot:
         print(decision)
 
     """
-    def __init__(self, api_key):
+    def __init__(self, api_key, price_encoding=RAW, stream=False, stream_tail='background', decision_cache=None, limiter=None, session=None):
+        """
+        Args:
+            api_key: your open AI api key
+            price_encoding: (str) how the price history is put in the prompt when
+                stock_info has "bars", 'raw' for every close price or 'compact'
+                for a short feature summary (see core.features)
+            stream: (bool) stream the answer and return the decision as soon as
+                its JSON object closes instead of waiting for the whole answer,
+                the decisions "message" is then empty and the feed back is
+                handled according to stream_tail
+            stream_tail: (str) what to do with the rest of a streamed answer,
+                'background' reads it on another thread and prints it,
+                'cancel' closes the stream
+            decision_cache: (DecisionCache) optional, decisions for news we have
+                already seen are answered from here without calling gpt
+            limiter: (RateLimiter) throttles and retries the openai calls,
+                defaults to the shared get_limiter('openai')
+            session: (Session) optional keep-alive session for the openai
+                calls, see core.sessions.make_session. openai only has one
+                session setting so this applies to every GPTBot
+        """
         openai.api_key = api_key
+        if session is not None:
+            openai.requestssession = session
+        if price_encoding not in (RAW, COMPACT):
+            raise Exception(f"unknown price encoding {price_encoding}")
+        self.price_encoding = price_encoding
+        if stream_tail not in ('background', 'cancel'):
+            raise Exception(f"unknown stream tail {stream_tail}")
+        self.stream = stream
+        self.stream_tail = stream_tail
+        self.decision_cache = decision_cache
+        self.limiter = limiter or get_limiter('openai')
+
+        # price history tokens that would have been sent with each encoding,
+        # both are counted so the saving can be compared
+        self.token_stats = {
+            "prompts": 0,
+            RAW: 0,
+            COMPACT: 0,
+        }
+        self.stats = {
+            "parse_failures": 0,
+            "batch_fallbacks": 0,
+            "cache_hits": 0,
+            "api_failures": 0,
+        }
+        self._stats_lock = threading.Lock()
 
     def make_trading_decision(self, stock_info, symbol):
         """Generate a trading decision based on the given stock information.
@@ -35,6 +88,8 @@ class GPTBot:
                 {
                     "news": (str) in json format,
                     "price_history": (list) price history in 15 min interval,
+                    "bars": (DataFrame) optional, the bars the price history came
+                        from, if set they are encoded with price_encoding instead
                     "open_position": (bool) is there an existing open position,
                     "capital": (float) how much money is available to spend on stocks,
                     ** if there is an open position**
@@ -43,26 +98,177 @@ class GPTBot:
                 }
         
         Return:
-            dict: should return a desision in this format
-            {
-                "buy": quantity (int) or null,
-                "sell": true or null,
-                "trail_percent": percentage for trailing stop loss,
-                "message": "optional feed back"
-            }
+            Decision: the validated decision, or None if gpt could not be
+                reached or its answer could not be parsed (counted in
+                stats["api_failures"] and stats["parse_failures"])
         """
+        key = None
+        if self.decision_cache is not None:
+            key = self.decision_cache.key(symbol, stock_info)
+            decision = self.decision_cache.get(key)
+            if decision is not None:
+                self._count("cache_hits")
+                logger.info("decision for %s from cache: %s", symbol, decision)
+                return decision
+
+        return self._make_and_cache(stock_info, symbol, key)
+
+    def _make_trading_decision(self, stock_info, symbol):
+        """make_trading_decision without the cache"""
         news = stock_info['news']
-        price_history = stock_info['price_history']
+        capital = stock_info['capital']
+
+        # Generate a prompt for GPT-3.5 based on the given information
+        prompt = f"News for symbol {symbol}: {news}\n\n"
+        prompt += self._stock_prompt(stock_info)
+        prompt += f"\nCapital: {capital}\n\n"
+        prompt += self._notes_prompt()
+        prompt += "based on the given information Please suggest the best trading decision in this JSON format:\n\n"
+        prompt += self._format_prompt()
+
+        logger.debug("prompt: %s", prompt)
+
+        content = self._complete(prompt, max_tokens=64)
+        if content is None:
+            return None
+
+        logger.debug("answer: %s", content)
+
+        # Parse the response and extract the trading decision
+        try:
+            decision = parse_decision(content)
+        except DecisionParseError as error:
+            self._count("parse_failures")
+            logger.warning("could not parse decision for %s: %s", symbol, error)
+            return None
+
+        logger.info("decision for %s: %s", symbol, decision)
+
+        return decision
+
+    def make_trading_decisions(self, stock_infos):
+        """Generate trading decisions for several stocks that share the same
+        news with a single gpt call instead of one call per stock.
+
+        if the answer for a symbol is missing or malformed that symbol (and
+        only that symbol) falls back to make_trading_decision.
+
+        Args:
+            stock_infos (list): stock_info dicts as described in
+                make_trading_decision, each with an extra "symbol" key.
+                the news of the first one is used for all of them
+
+        Return:
+            dict: symbol: Decision (or None) as returned by make_trading_decision
+        """
+        results = {}
+        keys = {}
+        if self.decision_cache is not None:
+            uncached = []
+            for stock_info in stock_infos:
+                symbol = stock_info['symbol']
+                keys[symbol] = self.decision_cache.key(symbol, stock_info)
+                decision = self.decision_cache.get(keys[symbol])
+                if decision is not None:
+                    self._count("cache_hits")
+                    results[symbol] = decision
+                else:
+                    uncached.append(stock_info)
+            stock_infos = uncached
+
+        if len(stock_infos) <= 1:
+            for stock_info in stock_infos:
+                symbol = stock_info['symbol']
+                results[symbol] = self._make_and_cache(stock_info, symbol, keys.get(symbol))
+            return results
+
+        symbols = [stock_info['symbol'] for stock_info in stock_infos]
+        news = stock_infos[0]['news']
+        capital = stock_infos[0]['capital']
+
+        prompt = f"News for symbols {', '.join(symbols)}: {news}\n\n"
+        for stock_info in stock_infos:
+            prompt += f"Symbol {stock_info['symbol']}:\n"
+            prompt += self._stock_prompt(stock_info)
+            prompt += "\n"
+        prompt += f"Capital (shared between all symbols): {capital}\n\n"
+        prompt += self._notes_prompt()
+        prompt += "based on the given information Please suggest the best trading decision for each symbol in this JSON format:\n\n"
+        prompt += self._format_prompt(batched=True)
+
+        logger.debug("prompt: %s", prompt)
+
+        decisions = {}
+        try:
+            content = self._complete(prompt, max_tokens=64 * len(stock_infos))
+            logger.debug("answer: %s", content)
+            if content is not None:
+                decisions = parse_decisions(content)
+        except DecisionParseError as error:
+            self._count("parse_failures")
+            logger.warning("could not parse batched decisions: %s", error)
+        except Exception as error:
+            logger.warning("failed to get batched answer from gpt: %s", error)
+
+        for stock_info in stock_infos:
+            symbol = stock_info['symbol']
+            decision = decisions.get(symbol)
+            if decision is not None:
+                results[symbol] = decision
+                if keys.get(symbol) is not None:
+                    self.decision_cache.put(keys[symbol], decision)
+            else:
+                # only this symbol pays for a second call
+                self._count("batch_fallbacks")
+                logger.info("batched decision for %s was malformed, asking again", symbol)
+                results[symbol] = self._make_and_cache(stock_info, symbol, keys.get(symbol))
+
+        logger.info("decisions: %s", results)
+
+        return results
+
+    def _make_and_cache(self, stock_info, symbol, key):
+        """single symbol decision for a symbol already checked against the cache"""
+        decision = self._make_trading_decision(stock_info, symbol)
+        if decision is not None and key is not None:
+            self.decision_cache.put(key, decision)
+        return decision
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _stock_prompt(self, stock_info):
+        """builds the part of the prompt that describes a single stock"""
+        price_history = self._price_history(stock_info)
         open_position = stock_info['open_position']
         opening_price = stock_info.get('opening_price')
         current_price = stock_info.get('current_price')
-        capital = stock_info['capital']
 
-        # Generate a prompt for GPT-3.5 based on the given information
-        prompt = f"News for symbol {symbol}: {news}\n\nPrice History(old to new, 15 min interval): {price_history}\n\nDo we own this stock currently: {open_position}\n"
+        prompt = f"Price History(old to new, 15 min interval): {price_history}\n\nDo we own this stock currently: {open_position}\n"
         if open_position:
             prompt += f"Opening Price: {opening_price}\nCurrent Price: {current_price}\n"
-        prompt += f"\nCapital: {capital}\n\n"
+        return prompt
+
+    def _price_history(self, stock_info):
+        """encodes the price history and keeps count of the tokens it costs"""
+        bars = stock_info.get('bars')
+        if bars is None:
+            return stock_info['price_history']
+
+        encoded = {encoding: encode_price_history(bars, encoding) for encoding in (RAW, COMPACT)}
+        tokens = {encoding: count_tokens(text) for encoding, text in encoded.items()}
+        with self._stats_lock:
+            self.token_stats["prompts"] += 1
+            for encoding, count in tokens.items():
+                self.token_stats[encoding] += count
+
+        logger.debug("price history tokens, raw: %d compact: %d (using %s)", tokens[RAW], tokens[COMPACT], self.price_encoding)
+        return encoded[self.price_encoding]
+
+    def _notes_prompt(self):
+        """builds the notes that go at the end of every prompt"""
+        prompt = ""
         # looks like you can only do full shares when doing trailing stop
         # prompt += "note: fractional shares is allowed, you dont need to buy a full share\n"
         # if fractional is not allowed for trailing stop orders then this line is useless as well
@@ -71,26 +277,46 @@ class GPTBot:
         # this line can easly be checked for on client side
         # prompt += "note: you may only spend a maximum amount of 10% of the capital amount\n"
         prompt += "note: trail_percent default is generally 0.01 (which is 1%), you can choose whatever value is appropriate\n"
-        prompt += """based on the given information Please suggest the best trading decision in this JSON format:\n
-{
+        return prompt
+
+    def _format_prompt(self, batched=False):
+        """builds the JSON format gpt has to answer in, when streaming the
+        feed back goes after the JSON so the decision arrives first"""
+        decision = """{
     "buy": quantity (int) or null,
     "sell": true or null,
-    "trail_percent": percentage_for_trailing_stop_loss,
-    "message": "optional feed back"
-}
+    "trail_percent": percentage_for_trailing_stop_loss"""
+        if not self.stream:
+            decision += ',\n    "message": "optional feed back"'
+        decision += "\n}"
+
+        if batched:
+            decision = '{\n    "SYMBOL": ' + decision.replace('\n', '\n    ') + ',\n    ...\n}'
+
+        prompt = decision + "\n\nnote: only return valid JSON"
+        if batched:
+            prompt += " with one key per symbol"
+        if self.stream:
+            prompt += ", optional feed back can go after the JSON"
+        return prompt + "\n"
 
-note: only return valid JSON
-"""
+    def _complete(self, prompt, max_tokens=64):
+        """sends the prompt to gpt and returns the text of the answer, or
+        None if gpt could not be reached (counted in stats["api_failures"])"""
+        if self.stream:
+            return self._complete_streaming(prompt, max_tokens=max_tokens)
 
-        print(f"prompt: {prompt}")
+        response = self._create(prompt, max_tokens)
+        if response is None:
+            return None
+        return response.choices[0].message.content
 
-        # Generate a completion using GPT-3.5
-        keep_trying = True
-        response = None
-        # need a better solution here this is asking to run up a bill
-        # while keep_trying:
+    def _create(self, prompt, max_tokens, stream=False):
+        """calls the chat completion api through the shared openai rate
+        limiter, which retries rate limit and server errors with backoff"""
         try:
-            response = openai.ChatCompletion.create(
+            return self.limiter.call(
+                openai.ChatCompletion.create,
                 model="gpt-3.5-turbo",
                 messages=[
                     {
@@ -103,56 +329,54 @@ note: only return valid JSON
                     },
                 ],
                 temperature=0.5,
-                max_tokens=64,
+                max_tokens=max_tokens,
                 top_p=1.0,
                 frequency_penalty=0.0,
-                presence_penalty=0.0
+                presence_penalty=0.0,
+                stream=stream,
             )
-            keep_trying = False
         except Exception as error:
-            print(error)
-            print('failed to get answer from gpt')
-            keep_trying = True
-
-        print(response.choices[0].message.content)
-
-        # Parse the response and extract the trading decision
-        decision = self._parse_trading_decision(response.choices[0].message.content)
-
-        print(f"decision: {decision}")
-
-        return decision
+            self._count("api_failures")
+            logger.warning('failed to get answer from gpt: %s', error)
+            return None
 
+    def _complete_streaming(self, prompt, max_tokens=64):
+        """streams the answer from gpt and returns as soon as the top level
+        JSON object is closed, whatever comes after it (the feed back) is
+        dealt with according to stream_tail off the critical path"""
+        response = self._create(prompt, max_tokens, stream=True)
+        if response is None:
+            return None
 
+        scanner = JsonObjectScanner()
+        text = ''
+        for chunk in response:
+            delta = chunk.choices[0].delta.get('content')
+            if not delta:
+                continue
+            text += delta
+            end = scanner.feed(delta)
+            if end is not None:
+                self._finish_tail(response, text[end:])
+                return text[:end]
 
-    def _parse_trading_decision(self, decision_text):
-        """Parse the trading decision from the given text.
-
-        Args:
-            decision_text (str): The text containing the trading decision.
-
-        Returns:
-            dict: A dictionary representing the trading decision with 'buy' and 'sell' amounts.
-
-        """
-
-        try:
-            # fix the json if gpt adds any extra charaters
-            arr = list(decision_text)
-
-            while arr[0] != '{':
-                arr.pop(0)
+        # the stream ended without the object closing, let the parser try its best
+        return text
 
-            while arr[-1] == ' ':
-                arr.pop(-1)
-            
-            if  arr[-1] != '}':
-                arr.append('"}')
+    def _finish_tail(self, response, tail):
+        """cancels or drains the rest of a streamed answer"""
+        if self.stream_tail == 'cancel':
+            # closing the generator drops the connection to openai
+            response.close()
+            return
 
-            decision_text = ''.join(arr)
+        def drain(tail):
+            try:
+                for chunk in response:
+                    tail += chunk.choices[0].delta.get('content') or ''
+            except Exception as error:
+                logger.warning("stream ended early: %s", error)
+            if tail.strip():
+                logger.info("message from gpt: %s", tail.strip())
 
-            result = json.loads(decision_text)
-            return result
-        except:
-            # perfaps the json is malfromed
-            raise Exception(decision_text)
+        threading.Thread(target=drain, args=(tail,), daemon=True).start()
@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+
+from core.files import write_json
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+class InstrumentIndex:
+    """ Remembers the instrument page url of every symbol easy equities has
+        found for us, so a buy can go straight to the page instead of
+        searching and paging through the results every time.
+
+        entries are added as symbols are found and dropped when the page
+        they point to no longer works, then the symbol is searched for again.
+
+        usage example:
+            index = InstrumentIndex('instruments.json')
+            url = index.get('AAPL')
+            if url is None:
+                url = ...
+                index.put('AAPL', url)
+
+    Args:
+        path: (str) optional json file to keep the index in across restarts
+        max_age: (float) seconds before an entry is looked up again anyway
+    """
+
+    def __init__(self, path=None, max_age=30 * 24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+
+        # symbol: (time.time() it was found, url)
+        self.entries = {}
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "stale": 0,
+        }
+        self._lock = threading.Lock()
+        self._load()
+
+    def get(self, symbol: str) -> str:
+        """ Returns:
+                str: the instrument url for the symbol or None if it isnt known
+        """
+        symbol = symbol.upper()
+        with self._lock:
+            entry = self.entries.get(symbol)
+            if entry is None or time.time() - entry[0] > self.max_age:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, symbol: str, url: str):
+        """ stores the instrument url for a symbol """
+        with self._lock:
+            self.entries[symbol.upper()] = (time.time(), url)
+            self._save()
+
+    def drop(self, symbol: str):
+        """ removes a symbol whose url didnt lead to its instrument page """
+        with self._lock:
+            if self.entries.pop(symbol.upper(), None) is not None:
+                self.stats["stale"] += 1
+                self._save()
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+            self.entries = {symbol: (found_at, url) for symbol, (found_at, url) in data.items()}
+        except Exception as error:
+            logger.warning("could not load the instrument index: %s", error)
+
+    def _save(self):
+        # must be called while holding the lock
+        if self.path is None:
+            return
+        data = {symbol: [found_at, url] for symbol, (found_at, url) in self.entries.items()}
+        try:
+            write_json(self.path, data)
+        except Exception as error:
+            logger.warning("could not save the instrument index: %s", error)
@@ -0,0 +1,94 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+ROOT = 'trading_bot'
+FORMAT = '%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s'
+
+_listener = None
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that drops records (and counts them) when the queue is
+        full instead of blocking or printing a traceback
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """ QueueListener whose stop waits for space in a full queue instead
+        of raising, so the records before it are still written
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """ Returns the logger for a module, all of them sit under the trading_bot
+        logger so setup_logging configures them in one place
+
+    Args:
+        name: (str) usually __name__
+    """
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def setup_logging(level='INFO', stream=None, max_queue=10000):
+    """ Sends the bots logs through a queue to a background thread, so logging
+        on the hot path never waits on stdout (which blocks when it is a full pipe).
+
+        usage example:
+            setup_logging('DEBUG')  # DEBUG also logs the full gpt prompts
+
+    Args:
+        level: (str or int) the lowest level to log, anything below it costs
+            next to nothing since the message is never formatted
+        stream: where to write the logs, defaults to stdout
+        max_queue: (int) records that can wait to be written before new ones
+            are dropped
+
+    Returns:
+        DroppingQueueHandler: the handler, its dropped attribute counts the
+            records that were dropped
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(FORMAT))
+
+    log_queue = queue.Queue(maxsize=max_queue)
+    handler = DroppingQueueHandler(log_queue)
+
+    logger = logging.getLogger(ROOT)
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    _listener = _QueueListener(log_queue, output)
+    _listener.start()
+    return handler
+
+
+def stop_logging():
+    """ writes out anything still in the queue and stops the log thread """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# the log thread is a daemon, without this whatever is still queued at exit is lost
+atexit.register(stop_logging)
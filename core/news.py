@@ -1,58 +1,247 @@
-import websocket
-import ssl
 import _thread
 import time
 import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 
-class News():
+import requests
 
-    def __init__(self, api_key, api_secret, target_symbols, on_news):
+from core import fast_json
+from core.log import get_logger
+from core.ratelimit import get_limiter
+from core.stream import ReconnectingStream
+
+logger = get_logger(__name__)
+
+STREAM_URL = "wss://stream.data.alpaca.markets/v1beta1/news"
+HISTORY_URL = "https://data.alpaca.markets/v1beta1/news"
+
+class News(ReconnectingStream):
+    """ Listens to alpacas news stream and calls on_news for every news item
+
+    Args:
+        api_key: alpaca api key
+        api_secret: alpaca secret key
+        target_symbols: the symbols to subscribe to, this can be a Watchlist so
+            a reconnect always subscribes to the current symbols
+        on_news: function called with every news item
+        all_news: (bool) subscribe to all news ("*") instead of the target
+            symbols, the symbols are then filtered locally by on_news and
+            symbols can be added or removed without sending anything
+        url: (str) overrides the stream url, eg a local websocket server for testing
+        history_url: (str) overrides the historical news url used for backfill
+        ping_interval: (float) seconds between pings to the server
+        ping_timeout: (float) seconds to wait for a pong before the connection
+            is considered dead and is reconnected
+        min_backoff: (float) seconds to wait before the first reconnect attempt
+        max_backoff: (float) the most seconds to wait between reconnect attempts
+        session: (Session) optional keep-alive session for the backfill
+    """
+
+    def __init__(self, api_key, api_secret, target_symbols, on_news, all_news=False,
+                 url=STREAM_URL, history_url=HISTORY_URL, ping_interval=20, ping_timeout=10,
+                 min_backoff=1, max_backoff=60, session=None):
+        super().__init__(url, "news stream", ping_interval=ping_interval, ping_timeout=ping_timeout,
+                         min_backoff=min_backoff, max_backoff=max_backoff)
         self.api_key = api_key
         self.api_secret = api_secret
         self.target_symbols = target_symbols
         self.on_news = on_news
+        self.all_news = all_news
+        self.history_url = history_url
+        # the backfill reuses its connection, see core.sessions.make_session
+        self.session = session or requests.Session()
+
+        # ids of the news we have already passed on, so backfill doesnt repeat them
+        self.seen_ids = OrderedDict()
+        self.max_seen_ids = 10000
+        # when the last frame arrived, the backfill after a reconnect starts
+        # from the last frame before the connection dropped (gap_start)
+        self.last_message_at = None
+        self.gap_start = None
+        self.disconnected_at = None
+        self.stats = {
+            "reconnects": 0,
+            "backfilled": 0,
+            # seconds from losing the connection to being authenticated again
+            "last_reconnect_latency": None,
+            "frames": 0,
+            "messages": 0,
+            "decode_seconds": 0.0,
+            "dispatch_seconds": 0.0,
+        }
+
+    def subscribe(self, symbols):
+        """ subscribes to news for more symbols without reconnecting, symbols
+            sent before authentication are picked up from target_symbols
+
+        Args:
+            symbols: (list) the symbols to add
+        """
+        symbols = list(symbols)
+        if not symbols or self.all_news:
+            return
+        self._send({"action": "subscribe", "news": symbols})
+
+    def unsubscribe(self, symbols):
+        """ unsubscribes from news for symbols without reconnecting
+
+        Args:
+            symbols: (list) the symbols to remove
+        """
+        symbols = list(symbols)
+        if not symbols or self.all_news:
+            return
+        self._send({"action": "unsubscribe", "news": symbols})
+
+    def _send(self, message):
+        if self.ws is None or not self.authenticated:
+            return
+        try:
+            self.ws.send(json.dumps(message))
+        except Exception as error:
+            logger.warning("could not send %s: %s", message['action'], error)
 
     def on_message(self, ws, message):
 
         try:
-            msgs = json.loads(message)
+            started = time.perf_counter()
+            self.last_message_at = datetime.now(timezone.utc)
+            msgs = fast_json.loads(message)
+            decoded = time.perf_counter()
             for msg in msgs:
-                print(msg)
+                logger.debug("message: %s", msg)
 
                 # if this if statment isnt the first to run it will not run
                 # probbly the dumbest thing ive encountered in python
                 if msg['T'].strip() == 'n':
                     # got news, call the function
-                    self.on_news({
-                        "headline": msg["headline"],
-                        "summary": msg["summary"],
-                        "created_at": msg["created_at"],
-                        "updated_at": msg["updated_at"],
-                        "symbols": msg["symbols"],
-                    })
-
-                if msg['msg'] == 'authenticated' and msg['T'] == 'success':
-                    ws.send(json.dumps({"action":"subscribe","news": self.target_symbols}))
-                
+                    self._remember(msg.get("id"))
+                    self.on_news(self._to_news(msg))
+
+                if msg['T'] == 'success' and msg.get('msg') == 'authenticated':
+                    self._authenticated()
+                    symbols = ["*"] if self.all_news else sorted(self.target_symbols)
+                    ws.send(json.dumps({"action":"subscribe","news": symbols}))
+                    self._on_reconnected()
+
+            # how long the websocket thread spends on each frame
+            self.stats["frames"] += 1
+            self.stats["messages"] += len(msgs)
+            self.stats["decode_seconds"] += decoded - started
+            self.stats["dispatch_seconds"] += time.perf_counter() - decoded
+
         except Exception as error:
-            print(error)
+            logger.exception("could not handle message: %s", error)
 
 
     def on_error(self, ws, error):
-        print(error)
+        logger.warning("news stream error: %s", error)
 
     def on_close(self, ws, close_status_code, close_msg):
-        print("### closed ###")
+        self.authenticated = False
+        self._disconnected()
+        logger.warning("### closed ###")
 
     def on_open(self, ws):
         ws.send(json.dumps({"action": "auth","key": self.api_key,"secret": self.api_secret}))
 
-    def run(self):
-        websocket.enableTrace(False)
-        ws = websocket.WebSocketApp("wss://stream.data.alpaca.markets/v1beta1/news",
-                                on_open=self.on_open,
-                                on_message=self.on_message,
-                                on_error=self.on_error,
-                                on_close=self.on_close)
+    def backfill(self, start: datetime):
+        """ fetches the news published since start from the historical news
+            api and passes on anything that hasnt been seen yet
+
+        Args:
+            start: (datetime) when to backfill from
+        """
+        headers = {"APCA-API-KEY-ID": self.api_key, "APCA-API-SECRET-KEY": self.api_secret}
+        params = {
+            "start": start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            "sort": "asc",
+            "limit": 50,
+        }
+        if not self.all_news:
+            params["symbols"] = ','.join(sorted(self.target_symbols))
+
+        count = 0
+        while True:
+            data = get_limiter('alpaca').call(self._get_page, headers, params)
+            for msg in data.get("news", []):
+                if msg.get("id") in self.seen_ids:
+                    continue
+                self._remember(msg.get("id"))
+                count += 1
+                self.on_news(self._to_news(msg))
+            if not data.get("next_page_token"):
+                break
+            params["page_token"] = data["next_page_token"]
+
+        self.stats["backfilled"] += count
+        logger.info("backfilled %d news items since %s", count, params['start'])
+
+    def _get_page(self, headers, params):
+        response = self.session.get(self.history_url, headers=headers, params=params, timeout=10)
+        # raises for 429 and 5xx so the limiter can retry them
+        response.raise_for_status()
+        return response.json()
+
+    def _on_reconnected(self):
+        """ called after every successful authentication """
+        if self.disconnected_at is None:
+            # first connection, nothing was missed
+            return
+
+        self.stats["reconnects"] += 1
+        self.stats["last_reconnect_latency"] = time.time() - self.disconnected_at
+        self.disconnected_at = None
+        logger.info("news stream reconnected after %.1fs", self.stats['last_reconnect_latency'])
+
+        # a little overlap, duplicates are filtered by id
+        start = (self.gap_start or datetime.now(timezone.utc)) - timedelta(seconds=30)
+        threading.Thread(target=self._safe_backfill, args=(start,), daemon=True).start()
+
+    def message_cost(self) -> dict:
+        """ Returns:
+                dict: average microseconds spent per message decoding the frame
+                    and passing the news on, and which decoder is used
+        """
+        messages = max(self.stats["messages"], 1)
+        return {
+            "decoder": fast_json.DECODER,
+            "messages": self.stats["messages"],
+            "decode_us": self.stats["decode_seconds"] / messages * 1e6,
+            "dispatch_us": self.stats["dispatch_seconds"] / messages * 1e6,
+        }
+
+    def _disconnected(self):
+        # on_close isnt always called so run calls this as well
+        if self.disconnected_at is None:
+            self.disconnected_at = time.time()
+            self.gap_start = self.last_message_at
+
+    def _safe_backfill(self, start):
+        try:
+            self.backfill(start)
+        except Exception as error:
+            logger.warning("news backfill failed: %s", error)
+
+    def _remember(self, news_id):
+        if news_id is None:
+            return
+        self.seen_ids[news_id] = True
+        self.seen_ids.move_to_end(news_id)
+        while len(self.seen_ids) > self.max_seen_ids:
+            self.seen_ids.popitem(last=False)
 
-        ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE})
\ No newline at end of file
+    def _to_news(self, msg):
+        """ the news item passed to on_news, the same shape whether it came
+            from the stream or the backfill
+        """
+        return {
+            "id": msg.get("id"),
+            "headline": msg["headline"],
+            "summary": msg["summary"],
+            "created_at": msg["created_at"],
+            "updated_at": msg["updated_at"],
+            "symbols": msg["symbols"],
+        }
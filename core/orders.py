@@ -0,0 +1,220 @@
+import statistics
+import threading
+import time
+import uuid
+from collections import deque
+
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+# trade update events after which an order wont change any more
+FINAL_EVENTS = ('fill', 'canceled', 'expired', 'rejected', 'replaced')
+
+# order statuses from the rest api that are named differently as trade update events
+STATUS_EVENTS = {'filled': 'fill', 'partially_filled': 'partial_fill'}
+
+class OrderHandle:
+    """ An order that was handed to AlpacaTrading.buy_async / sell_async,
+        returned straight away and updated in the background as the order
+        is submitted and then accepted, (partially) filled or rejected
+
+        usage example:
+            handle = alpaca.buy_async('AAPL', qty=1, callback=lambda handle: print(handle))
+            ...
+            handle.wait(timeout=30)
+
+    Args:
+        symbol: (str) the stock symbol
+        side: (str) 'buy' or 'sell'
+        client_order_id: (str) our id for the order, used to match the trade
+            updates to the handle before alpaca has told us its order id
+    """
+
+    def __init__(self, symbol, side, client_order_id):
+        self.symbol = symbol
+        self.side = side
+        self.client_order_id = client_order_id
+        self.order_id = None
+        # 'submitting' until alpaca answers, then the last trade update event
+        self.status = 'submitting'
+        self.filled_qty = 0.0
+        self.filled_avg_price = None
+        self.error = None
+        self.submitted_at = time.monotonic()
+        # when we last heard anything about the order, see OrderTracker.stale
+        self.updated_at = self.submitted_at
+        self.filled_at = None
+        self._done = threading.Event()
+        self._callbacks = []
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def fill_latency(self) -> float:
+        """ seconds from submitting to the order being filled, None if it
+            wasnt (fully) filled
+        """
+        if self.filled_at is None:
+            return None
+        return self.filled_at - self.submitted_at
+
+    def wait(self, timeout=None) -> bool:
+        """ blocks until the order is done
+
+        Returns:
+            bool: True if the order is done, False if the timeout ran out
+        """
+        return self._done.wait(timeout)
+
+    def __repr__(self):
+        return f"OrderHandle({self.side} {self.symbol}, status={self.status}, filled_qty={self.filled_qty})"
+
+
+class OrderTracker:
+    """ Follows the orders placed through the async api from the trade
+        updates stream, runs their callbacks once they are done and keeps
+        the submit to fill latency of every filled order
+
+    Args:
+        max_latencies: (int) how many fill latencies to keep for the stats
+    """
+
+    def __init__(self, max_latencies=1000):
+        # client order id: OrderHandle, only the orders that arent done yet
+        self.active = {}
+        self.fill_latencies = deque(maxlen=max_latencies)
+        self.stats = {
+            "submitted": 0,
+            "filled": 0,
+            "partial_fills": 0,
+            "rejected": 0,
+            "canceled": 0,
+        }
+        self._lock = threading.Lock()
+
+    def create(self, symbol, side, callback=None) -> OrderHandle:
+        """ Returns:
+                OrderHandle: a new handle being tracked
+        """
+        handle = OrderHandle(symbol, side, client_order_id=uuid.uuid4().hex)
+        if callback is not None:
+            handle._callbacks.append(callback)
+        with self._lock:
+            self.active[handle.client_order_id] = handle
+            self.stats["submitted"] += 1
+        return handle
+
+    def submitted(self, handle, order):
+        """ records alpacas answer to the submit, the stream can beat it so a
+            finished handle is left alone
+        """
+        with self._lock:
+            handle.order_id = str(order.id)
+            handle.updated_at = time.monotonic()
+            if not handle.done:
+                handle.status = 'accepted'
+
+    def failed(self, handle, error):
+        """ the submit itself failed (pending order, no position, api error) """
+        with self._lock:
+            handle.error = error
+        self._finish(handle, 'rejected')
+
+    def apply_trade_update(self, update: dict):
+        """ updates the handle the trade update is for, if it is one of ours
+
+        Args:
+            update: (dict) the "data" of a trade_updates message
+        """
+        order = update.get("order") or {}
+        with self._lock:
+            handle = self.active.get(order.get("client_order_id"))
+            if handle is None:
+                return
+            event = update.get("event")
+            self._update(handle, event, order.get("id"), order.get("filled_qty"), order.get("filled_avg_price"))
+
+        if event in FINAL_EVENTS:
+            self._finish(handle, event)
+
+    def stale(self, max_age) -> list:
+        """ Returns:
+                list: the submitted handles that havent been updated for max_age
+                    seconds, the stream may have missed them (eg while it was
+                    disconnected) so they should be looked up with apply_order
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [handle for handle in self.active.values()
+                    if handle.order_id is not None and now - handle.updated_at > max_age]
+
+    def apply_order(self, handle, order):
+        """ updates a handle from the order as the rest api returns it, the
+            fallback for when no trade update arrives
+
+        Args:
+            handle: (OrderHandle) the handle the order is for
+            order: the alpaca Order with the same client_order_id
+        """
+        status = str(getattr(order.status, 'value', order.status))
+        event = STATUS_EVENTS.get(status, status)
+        with self._lock:
+            if handle.done:
+                return
+            self._update(handle, event, order.id, order.filled_qty, order.filled_avg_price)
+
+        if event in FINAL_EVENTS:
+            self._finish(handle, event)
+
+    def latency_stats(self) -> dict:
+        """ Returns:
+                dict: count, mean, median and max seconds from submit to fill
+        """
+        latencies = list(self.fill_latencies)
+        if not latencies:
+            return {"count": 0}
+        return {
+            "count": len(latencies),
+            "mean": statistics.mean(latencies),
+            "median": statistics.median(latencies),
+            "max": max(latencies),
+        }
+
+    def _update(self, handle, event, order_id, filled_qty, filled_avg_price):
+        # must be called while holding the lock
+        if order_id is not None:
+            handle.order_id = str(order_id)
+        handle.status = event
+        handle.updated_at = time.monotonic()
+        if filled_qty is not None:
+            handle.filled_qty = float(filled_qty)
+        if filled_avg_price is not None:
+            handle.filled_avg_price = float(filled_avg_price)
+        if event == 'partial_fill':
+            self.stats["partial_fills"] += 1
+
+    def _finish(self, handle, status):
+        with self._lock:
+            if handle.done:
+                return
+            handle.status = status
+            self.active.pop(handle.client_order_id, None)
+            if status == 'fill':
+                handle.filled_at = time.monotonic()
+                self.fill_latencies.append(handle.fill_latency)
+                self.stats["filled"] += 1
+            elif status == 'rejected':
+                self.stats["rejected"] += 1
+            else:
+                self.stats["canceled"] += 1
+            handle._done.set()
+
+        # callbacks run outside the lock so they can place more orders
+        for callback in handle._callbacks:
+            try:
+                callback(handle)
+            except Exception as error:
+                logger.exception("order callback failed for %s: %s", handle.symbol, error)
@@ -0,0 +1,186 @@
+import threading
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+# buy order events after which the order is still waiting to be filled
+OPEN_EVENTS = ('new', 'accepted', 'pending_new')
+# buy order events after which whatever wasnt filled wont be
+CLOSED_EVENTS = ('canceled', 'expired', 'rejected', 'replaced')
+
+class PositionState:
+    """ A local copy of an open position, has the same attributes process_stock
+        uses from alpacas Position so either can be used
+
+    Args:
+        symbol: (str) the stock symbol
+        qty: (float) how many shares are held
+        avg_entry_price: (float) average price the shares were bought at
+        current_price: (float) last known price
+    """
+
+    def __init__(self, symbol, qty, avg_entry_price, current_price=None):
+        self.symbol = symbol
+        self.qty = float(qty)
+        self.avg_entry_price = float(avg_entry_price)
+        self.current_price = float(current_price) if current_price is not None else self.avg_entry_price
+
+    def __repr__(self):
+        return f"PositionState(symbol={self.symbol!r}, qty={self.qty}, avg_entry_price={self.avg_entry_price}, current_price={self.current_price})"
+
+
+class Portfolio:
+    """ Keeps the balance and open positions in memory so process_stock doesnt
+        have to ask alpaca for them after every order.
+
+        it is seeded once from the REST api and then kept up to date with the
+        fills from the trade updates stream (see TradeUpdates). like alpacas
+        buying_power the balance leaves out what open buy orders will cost,
+        qty x last price is held back from the balance when a buy order is
+        accepted and given back as it fills or is canceled.
+
+        usage example:
+            portfolio = Portfolio(alpaca)
+            trade_updates = TradeUpdates(..., on_trade_update=portfolio.apply_trade_update)
+            portfolio.balance
+
+    Args:
+        alpaca: (AlpacaTrading) used to seed (and resync) the state
+        last_price: optional function called as last_price(symbol) that returns
+            the latest known price or None, used to price open buy orders
+    """
+
+    def __init__(self, alpaca, last_price=None):
+        self.alpaca = alpaca
+        self.last_price = last_price
+        self.balance = 0.0
+        # order id: [price, qty not filled yet] of the open buy orders whose
+        # cost is held back from the balance
+        self.reserved = {}
+        # symbol: PositionState, this dict is never changed in place, a new one
+        # is swapped in on every change so workers can read it without a lock
+        self.positions = {}
+        self._lock = threading.Lock()
+        self.stats = {
+            "fills": 0,
+            "resyncs": 0,
+        }
+        self.resync()
+
+    def resync(self):
+        """ reloads the balance and positions from alpaca, only needed at
+            startup or if trade updates might have been missed
+        """
+        balance = self.alpaca.get_available_cash()
+        positions = {}
+        for position in self.alpaca.get_positions():
+            positions[position.symbol] = PositionState(position.symbol, position.qty, position.avg_entry_price, position.current_price)
+
+        with self._lock:
+            # buying_power already leaves out the open orders, only forget the
+            # ones that are no longer open so they arent given back twice
+            open_ids = {order_id for orders in self.alpaca.open_orders.values() for order_id in orders}
+            self.reserved = {order_id: reserve for order_id, reserve in self.reserved.items() if order_id in open_ids}
+            self.balance = balance
+            self.positions = positions
+            self.stats["resyncs"] += 1
+
+    def get_positions(self) -> list:
+        """ Returns:
+                list: the open positions (PositionState)
+        """
+        return list(self.positions.values())
+
+    def get_position(self, symbol: str) -> PositionState:
+        """ Returns:
+                PositionState: the open position for the symbol or None
+        """
+        return self.positions.get(symbol)
+
+    def apply_trade_update(self, update: dict):
+        """ updates the balance and positions from a trade update
+
+        Args:
+            update: (dict) the "data" of a trade_updates message
+                {"event": "fill", "price": "10.0", "qty": "2", "position_qty": "2",
+                 "order": {"symbol": "AAPL", "side": "buy", ...}}
+        """
+        event = update.get("event")
+        order = update.get("order") or {}
+        if order.get("side") == "buy" and event in OPEN_EVENTS + CLOSED_EVENTS:
+            self._reserve(order, event)
+        if event not in ("fill", "partial_fill"):
+            return
+
+        symbol = order["symbol"]
+        price = float(update["price"])
+        qty = float(update["qty"])
+        notional = price * qty
+
+        with self._lock:
+            self.stats["fills"] += 1
+            current = self.positions.get(symbol)
+
+            if order["side"] == "buy":
+                self.balance -= notional
+                self._release(str(order.get("id")), qty, final=event == "fill")
+                held_qty = current.qty if current is not None else 0.0
+                held_price = current.avg_entry_price if current is not None else price
+                expected_qty = held_qty + qty
+                avg_entry_price = (held_price * held_qty + notional) / expected_qty
+            else:
+                self.balance += notional
+                if current is None:
+                    return
+                expected_qty = current.qty - qty
+                avg_entry_price = current.avg_entry_price
+
+            # alpaca sends the resulting position size, trust that over our maths
+            new_qty = float(update["position_qty"]) if update.get("position_qty") is not None else expected_qty
+
+            positions = dict(self.positions)
+            if abs(new_qty) < 1e-9:
+                positions.pop(symbol, None)
+            else:
+                positions[symbol] = PositionState(symbol, new_qty, avg_entry_price, price)
+            self.positions = positions
+
+    def _reserve(self, order, event):
+        """ holds back (or gives back) the cost of an open buy order """
+        order_id = str(order.get("id"))
+        with self._lock:
+            if event in CLOSED_EVENTS:
+                self._release(order_id, final=True)
+                return
+            if order_id in self.reserved:
+                return
+            price = self._price(order)
+            if price is None:
+                logger.debug("no price to reserve the %s order with", order["symbol"])
+                return
+            qty = float(order.get("qty") or 0) - float(order.get("filled_qty") or 0)
+            self.reserved[order_id] = [price, qty]
+            self.balance -= price * qty
+
+    def _release(self, order_id, qty=None, final=False):
+        # must be called while holding the lock
+        reserve = self.reserved.get(order_id)
+        if reserve is None:
+            return
+        price, remaining = reserve
+        released = remaining if final or qty is None else min(qty, remaining)
+        self.balance += price * released
+        if final or released >= remaining:
+            del self.reserved[order_id]
+        else:
+            self.reserved[order_id] = [price, remaining - released]
+
+    def _price(self, order):
+        price = self.last_price(order["symbol"]) if self.last_price is not None else None
+        if price is None:
+            # trailing stops carry the high water mark once alpaca has priced them
+            price = order.get("limit_price") or order.get("hwm")
+        if price is None:
+            position = self.positions.get(order["symbol"])
+            price = position.current_price if position is not None else None
+        return float(price) if price is not None else None
@@ -0,0 +1,224 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+class TokenBucket:
+    """ Classic token bucket, tokens refill at `rate` per second up to `capacity`
+
+    Args:
+        rate: (float) tokens added per second
+        capacity: (float) most tokens the bucket can hold (the burst size)
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ takes a token, waiting for one to refill if the bucket is empty """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ empties the bucket so nobody calls for the next `seconds`, used
+            when a provider tells us to back off
+        """
+        with self._lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+            self.updated_at = time.monotonic()
+
+
+class RateLimiter:
+    """ Throttles and retries the calls to one provider (openai, alpaca,
+        yfinance), shared by every worker so together they stay under the
+        providers limits.
+
+        every call takes a token from the bucket and a concurrency slot, calls
+        that fail with a rate limit, server or connection error are retried
+        with exponential backoff (or the providers Retry-After if it sent one).
+
+        usage example:
+            limiter = get_limiter('openai')
+            response = limiter.call(openai.ChatCompletion.create, model=..., messages=...)
+
+    Args:
+        name: (str) the provider, used in the logs
+        rate: (float) calls per second
+        burst: (int) calls that can be made at once after being idle
+        max_concurrency: (int) calls that can be in flight at the same time
+        max_retries: (int) retries before the error is raised
+        base_delay: (float) seconds to wait before the first retry
+        max_delay: (float) the longest wait between retries
+    """
+
+    def __init__(self, name, rate, burst=1, max_concurrency=4, max_retries=4, base_delay=1, max_delay=30):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {
+            "calls": 0,
+            "retries": 0,
+            "failures": 0,
+            "throttled": 0,
+        }
+        self._stats_lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        """ calls function(*args, **kwargs) under the rate limit, retrying
+            anything retryable. only use this for calls that are safe to repeat
+
+        Returns:
+            whatever function returns
+
+        Raises:
+            the last error once max_retries is used up, or straight away if
+            the error isnt retryable
+        """
+        return self._call(function, args, kwargs, idempotent=True)
+
+    def call_once(self, function, *args, **kwargs):
+        """ like call but for calls that must not happen twice (like placing an
+            order), only retried when the provider rejected it with a 429
+            since then we know it was never processed
+        """
+        return self._call(function, args, kwargs, idempotent=False)
+
+    def _call(self, function, args, kwargs, idempotent):
+        attempt = 0
+        while True:
+            failure = None
+            self.bucket.acquire()
+            with self.slots:
+                self._count("calls")
+                try:
+                    return function(*args, **kwargs)
+                except Exception as error:
+                    status = status_code(error)
+                    if status == 429:
+                        self._count("throttled")
+                    retryable = status == 429 or (idempotent and is_transient(error, status))
+                    if not retryable or attempt >= self.max_retries:
+                        self._count("failures")
+                        raise
+                    failure = error
+
+            retry_after = get_retry_after(failure)
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+                # nobody else should call this provider until the wait is over
+                self.bucket.pause(retry_after)
+            attempt += 1
+            self._count("retries")
+            logger.warning("%s call failed (%s), retry %d in %.1fs", self.name, failure, attempt, delay)
+            time.sleep(delay)
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+
+def status_code(error):
+    """ Returns:
+            int: the http status of an error from openai, alpaca or requests,
+                None if there isnt one
+    """
+    for attribute in ('http_status', 'status_code'):
+        status = getattr(error, attribute, None)
+        if isinstance(status, int):
+            return status
+    response = _response(error)
+    return getattr(response, 'status_code', None)
+
+
+def is_transient(error, status=None):
+    """ Returns:
+            bool: True for server errors, timeouts and dropped connections
+    """
+    if status is not None:
+        return status >= 500
+    name = type(error).__name__
+    return any(word in name for word in ('Timeout', 'Connection', 'ServiceUnavailable', 'TryAgain'))
+
+
+def get_retry_after(error):
+    """ Returns:
+            float: seconds the provider asked us to wait, or None
+    """
+    headers = getattr(error, 'headers', None)
+    if not headers:
+        response = _response(error)
+        headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        # it can also be an http date
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _response(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        # alpaca-py keeps the requests error in _http_error
+        http_error = getattr(error, '_http_error', None)
+        response = getattr(http_error, 'response', None)
+    return response
+
+
+# one limiter per provider, shared by everything in the process. the defaults
+# stay under the free / basic tiers, change them with configure
+_limiters = {
+    "openai": RateLimiter("openai", rate=1, burst=3, max_concurrency=4),
+    "alpaca": RateLimiter("alpaca", rate=3, burst=10, max_concurrency=4),
+    "yfinance": RateLimiter("yfinance", rate=2, burst=4, max_concurrency=4),
+}
+_limiters_lock = threading.Lock()
+
+def get_limiter(provider: str) -> RateLimiter:
+    """ Returns:
+            RateLimiter: the shared limiter for the provider
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = RateLimiter(provider, rate=1)
+        return _limiters[provider]
+
+
+def configure(provider: str, **kwargs) -> RateLimiter:
+    """ replaces the shared limiter for a provider, takes the same arguments
+        as RateLimiter (other than name)
+
+        usage example:
+            configure('openai', rate=50, burst=20, max_concurrency=8)
+    """
+    with _limiters_lock:
+        _limiters[provider] = RateLimiter(provider, **kwargs)
+        return _limiters[provider]
@@ -0,0 +1,252 @@
+import json
+import re
+import sys
+import threading
+import time
+
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+# words that usually mean the news can move the stock, and how much
+LEXICON = {
+    "earnings": 0.3, "revenue": 0.2, "guidance": 0.3, "forecast": 0.2, "outlook": 0.2,
+    "beats": 0.3, "misses": 0.3, "profit": 0.2, "loss": 0.15, "quarter": 0.1,
+    "upgrade": 0.3, "upgrades": 0.3, "downgrade": 0.3, "downgrades": 0.3, "price target": 0.25,
+    "acquire": 0.3, "acquires": 0.3, "acquisition": 0.3, "merger": 0.3, "deal": 0.15, "stake": 0.15,
+    "buyback": 0.25, "dividend": 0.2, "split": 0.2, "offering": 0.2,
+    "lawsuit": 0.25, "sues": 0.25, "probe": 0.25, "investigation": 0.25, "antitrust": 0.25, "fine": 0.15,
+    "recall": 0.25, "fda": 0.3, "approval": 0.2, "launch": 0.15, "launches": 0.15, "unveils": 0.15,
+    "layoffs": 0.25, "ceo": 0.2, "resigns": 0.3, "steps down": 0.3, "bankruptcy": 0.4,
+    "surges": 0.15, "soars": 0.15, "plunges": 0.15, "tumbles": 0.15, "halted": 0.3,
+}
+
+# roundups and listicles that only mention our symbol in passing
+ROUNDUP_PATTERNS = [
+    r"\bstocks? to (watch|buy|sell)\b",
+    r"\btop \d+\b",
+    r"\b\d+ (stocks|companies|names)\b",
+    r"\b(biggest|top|notable) (movers|gainers|losers)\b",
+    r"\b(mid-?day|pre-?market|after-?hours)\b.*\bmovers\b",
+    r"\bstocks? moving\b",
+    r"\bmarket (wrap|recap|update)\b",
+    r"\b(whale|options) activity\b",
+    r"\bearnings (calendar|preview|scheduled)\b",
+    r"\bwhat('s| is) going on\b",
+]
+
+# names the companies go by in headlines, symbols not in here are only
+# matched by their ticker
+COMPANY_NAMES = {
+    "AAPL": ["Apple"],
+    "MSFT": ["Microsoft"],
+    "GOOGL": ["Alphabet", "Google"],
+    "NVDA": ["Nvidia"],
+    "TSM": ["TSMC", "Taiwan Semiconductor"],
+    "META": ["Meta", "Facebook", "Instagram"],
+    "AVGO": ["Broadcom"],
+    "AMD": ["Advanced Micro Devices"],
+    "TSLA": ["Tesla"],
+    "AMZN": ["Amazon"],
+    "RBLX": ["Roblox"],
+    "ACN": ["Accenture"],
+    "ATVI": ["Activision"],
+}
+
+class RelevanceScorer:
+    """ Scores how much a news item is actually about a symbol, without any
+        network calls, so news that only mentions one of our symbols in
+        passing (sector roundups, listicles) never reaches gpt.
+
+        the score (0 to 1) is made of
+            - prominence: the symbol (or company name) in the headline, or
+              being the only symbol the news is tagged with, counts most, in
+              the summary less, and news tagged with lots of symbols counts
+              for less than news about one company
+            - lexicon: words that usually move a stock (earnings, downgrade,
+              acquisition, fda etc)
+            - roundups: headlines that look like lists of stocks lose points
+
+        usage example:
+            scorer = RelevanceScorer(threshold=0.35)
+            if scorer.is_relevant(news, 'AAPL'):
+                ...
+
+        tune the threshold offline against news recorded with
+        TradingBot(news_log_path=...):
+            python -m core.relevance tune news.jsonl
+            python -m core.relevance bench news.jsonl
+
+    Args:
+        threshold: (float) the least score that gets passed on
+        lexicon: (dict) word or phrase: weight, defaults to LEXICON
+        company_names: (dict) symbol: list of names, defaults to COMPANY_NAMES
+        roundup_patterns: (list) regexes for roundup headlines, defaults to
+            ROUNDUP_PATTERNS
+    """
+
+    HEADLINE_WEIGHT = 0.45
+    SUMMARY_WEIGHT = 0.15
+    ROUNDUP_PENALTY = 0.35
+    LEXICON_CAP = 0.4
+
+    def __init__(self, threshold=0.35, lexicon=None, company_names=None, roundup_patterns=None):
+        self.threshold = threshold
+        self.company_names = COMPANY_NAMES if company_names is None else company_names
+        lexicon = LEXICON if lexicon is None else lexicon
+
+        # one alternation for the whole lexicon, longest phrases first
+        words = sorted(lexicon, key=len, reverse=True)
+        self.lexicon = {word.lower(): weight for word, weight in lexicon.items()}
+        self._lexicon_re = re.compile(r"\b(" + "|".join(re.escape(word) for word in words) + r")\b", re.IGNORECASE)
+        self._roundup_re = re.compile("|".join(ROUNDUP_PATTERNS if roundup_patterns is None else roundup_patterns), re.IGNORECASE)
+        # symbol: compiled regex for the ticker and company names
+        self._symbol_res = {}
+
+        self.stats = {
+            "scored": 0,
+            "passed": 0,
+            "filtered": 0,
+        }
+        self._lock = threading.Lock()
+
+    def score(self, news: dict, symbol: str) -> float:
+        """ Returns:
+                float: how relevant the news is to the symbol, 0 to 1
+        """
+        headline = news.get("headline") or ""
+        summary = news.get("summary") or ""
+        symbol_re = self._symbol_re(symbol)
+
+        # news about one company is more likely to move it than news about ten
+        tagged = len(news.get("symbols") or []) or 1
+
+        score = 0.0
+        mentioned = True
+        # alpaca tagging only our symbol says the news is about it, even when
+        # the headline uses a name we dont know ("Tim Cook", "Netflix")
+        if symbol_re.search(headline) or tagged == 1:
+            score += self.HEADLINE_WEIGHT
+        elif symbol_re.search(summary):
+            score += self.SUMMARY_WEIGHT
+        else:
+            mentioned = False
+
+        score += 0.25 / tagged
+
+        keywords = {match.lower() for match in self._lexicon_re.findall(headline + " " + summary)}
+        lexicon_score = min(self.LEXICON_CAP, sum(self.lexicon[word] for word in keywords))
+        # the keywords are probably about another company if ours isnt named
+        score += lexicon_score if mentioned else lexicon_score / 2
+
+        if self._roundup_re.search(headline):
+            score -= self.ROUNDUP_PENALTY
+
+        return max(0.0, min(1.0, score))
+
+    def is_relevant(self, news: dict, symbol: str) -> bool:
+        """ Returns:
+                bool: True if the news scores at least the threshold
+        """
+        score = self.score(news, symbol)
+        relevant = score >= self.threshold
+        with self._lock:
+            self.stats["scored"] += 1
+            self.stats["passed" if relevant else "filtered"] += 1
+        if not relevant:
+            logger.debug("news not relevant to %s (%.2f): %s", symbol, score, news.get("headline"))
+        return relevant
+
+    def _symbol_re(self, symbol):
+        symbol_re = self._symbol_res.get(symbol)
+        if symbol_re is None:
+            # tickers and company names are matched case sensitive so "META"
+            # and "Meta" dont match "meta data", names are proper nouns anyway
+            names = [name for name in self.company_names.get(symbol, []) if name != symbol]
+            parts = [re.escape(symbol)] + [re.escape(name) for name in names]
+            symbol_re = re.compile(r"(?<![\w$])\$?(?:" + "|".join(parts) + r")\b")
+            self._symbol_res[symbol] = symbol_re
+        return symbol_re
+
+
+def load_recorded(path):
+    """ loads news recorded as json lines, each line is a news item and can
+        have a "relevant" dict of symbol: bool labels for tuning
+
+    Returns:
+        list: the news items
+    """
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def benchmark(scorer, items, repeat=5):
+    """ Returns:
+            float: (news, symbol) pairs scored per second
+    """
+    pairs = [(news, symbol) for news in items for symbol in news.get("symbols") or []]
+    if not pairs:
+        return 0.0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for news, symbol in pairs:
+            scorer.score(news, symbol)
+    return len(pairs) * repeat / (time.perf_counter() - started)
+
+
+def tune(scorer, items, symbols=None, steps=20):
+    """ scores every recorded (news, symbol) pair once and reports what each
+        threshold would let through, with precision and recall for the pairs
+        that have a label
+
+    Args:
+        scorer: (RelevanceScorer) the scorer to tune
+        items: (list) recorded news
+        symbols: (set) only score these symbols, eg the watchlist
+        steps: (int) how many thresholds between 0 and 1 to try
+
+    Returns:
+        list: one dict per threshold with threshold, pass_rate and (if
+            there are labels) precision, recall and f1
+    """
+    scored = []
+    for news in items:
+        labels = news.get("relevant") or {}
+        for symbol in news.get("symbols") or []:
+            if symbols is not None and symbol not in symbols:
+                continue
+            scored.append((scorer.score(news, symbol), labels.get(symbol)))
+
+    results = []
+    for step in range(steps + 1):
+        threshold = step / steps
+        passed = [(score, label) for score, label in scored if score >= threshold]
+        result = {"threshold": threshold, "pass_rate": len(passed) / len(scored) if scored else 0.0}
+        labelled = [(score >= threshold, label) for score, label in scored if label is not None]
+        if labelled:
+            true_positive = sum(1 for kept, label in labelled if kept and label)
+            kept = sum(1 for kept, _ in labelled if kept)
+            relevant = sum(1 for _, label in labelled if label)
+            precision = true_positive / kept if kept else 0.0
+            recall = true_positive / relevant if relevant else 0.0
+            result.update({
+                "precision": precision,
+                "recall": recall,
+                "f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            })
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    # python -m core.relevance tune|bench news.jsonl
+    command, path = sys.argv[1], sys.argv[2]
+    scorer = RelevanceScorer()
+    items = load_recorded(path)
+    if command == "bench":
+        print(f"{benchmark(scorer, items):,.0f} items/s")
+    elif command == "tune":
+        for result in tune(scorer, items):
+            print("  ".join(f"{key}: {value:.2f}" for key, value in result.items()))
+    else:
+        raise Exception(f"unknown command {command}, use tune or bench")
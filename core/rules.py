@@ -0,0 +1,184 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+class PreFilter:
+    """ Rules checked before a symbol is evaluated, when the outcome is already
+        decided (we cant buy and have nothing to sell, theres already an order
+        waiting etc) the gpt call and the order are skipped.
+
+        a rule is any callable taking the symbol and returning the reason to
+        skip it (str) or None, with a `name` used for the hit counts. rules are
+        checked in order so put the cheap ones first.
+
+        usage example:
+            prefilter = PreFilter([InsufficientCapital(portfolio), PendingOrder(alpaca)])
+            reason = prefilter.check('AAPL')
+            if reason is not None:
+                return
+
+    Args:
+        rules: (list) the rules to check
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        # rule name: how many symbols it skipped
+        self.stats = {rule.name: 0 for rule in self.rules}
+        self.stats["passed"] = 0
+        self._lock = threading.Lock()
+
+    def check(self, symbol: str, count: bool=True) -> str:
+        """ Returns the reason the symbol should be skipped
+
+        Args:
+            symbol: (str) the stock symbol
+            count: (bool) add the result to stats, False for checks that are
+                repeated for the same evaluation
+
+        Returns:
+            str: why the symbol was skipped or None if every rule passed
+        """
+        for rule in self.rules:
+            try:
+                reason = rule(symbol)
+            except Exception as error:
+                # a broken rule shouldnt stop trading, let gpt decide
+                logger.warning("rule %s failed for %s: %s", rule.name, symbol, error)
+                continue
+            if reason is not None:
+                if count:
+                    self._count(rule.name)
+                return f"{rule.name}: {reason}"
+        if count:
+            self._count("passed")
+        return None
+
+    def record_trade(self, symbol: str):
+        """ tells the rules that keep track of trades (eg Cooldown) that an
+            order was just placed for the symbol
+        """
+        for rule in self.rules:
+            record = getattr(rule, 'record', None)
+            if record is not None:
+                record(symbol)
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+class InsufficientCapital:
+    """ skips symbols we dont hold when there isnt enough money to buy any
+
+    Args:
+        portfolio: (Portfolio) the local balance and positions
+        min_capital: (float) the least we need to open a position
+    """
+    name = "insufficient_capital"
+
+    def __init__(self, portfolio, min_capital=20):
+        self.portfolio = portfolio
+        self.min_capital = min_capital
+
+    def __call__(self, symbol):
+        if self.portfolio.get_position(symbol) is None and self.portfolio.balance < self.min_capital:
+            return f"balance {self.portfolio.balance:.2f} is below {self.min_capital}"
+        return None
+
+
+class MaxPositions:
+    """ skips symbols we dont hold once we already hold max_positions stocks,
+        so the capital isnt spread over more positions than we want
+
+    Args:
+        portfolio: (Portfolio) the local balance and positions
+        max_positions: (int) the most positions to hold at once
+    """
+    name = "max_positions"
+
+    def __init__(self, portfolio, max_positions=10):
+        self.portfolio = portfolio
+        self.max_positions = max_positions
+
+    def __call__(self, symbol):
+        if self.portfolio.get_position(symbol) is not None:
+            return None
+        count = len(self.portfolio.get_positions())
+        if count >= self.max_positions:
+            return f"already holding {count} positions"
+        return None
+
+
+class Cooldown:
+    """ skips symbols we placed an order for less than `seconds` ago
+
+    Args:
+        seconds: (float) how long to leave a symbol alone after trading it
+    """
+    name = "cooldown"
+
+    def __init__(self, seconds=900):
+        self.seconds = seconds
+        # symbol: time.monotonic() of the last order
+        self.last_trade = {}
+
+    def __call__(self, symbol):
+        traded_at = self.last_trade.get(symbol)
+        if traded_at is not None:
+            elapsed = time.monotonic() - traded_at
+            if elapsed < self.seconds:
+                return f"traded {elapsed:.0f}s ago"
+        return None
+
+    def record(self, symbol):
+        self.last_trade[symbol] = time.monotonic()
+
+
+class PendingOrder:
+    """ skips symbols that still have an open order, it has to fill or be
+        canceled before we trade the symbol again
+
+    Args:
+        alpaca: (AlpacaTrading) used to look up the open orders
+    """
+    name = "pending_order"
+
+    def __init__(self, alpaca):
+        self.alpaca = alpaca
+
+    def __call__(self, symbol):
+        if self.alpaca.has_pending_order(symbol):
+            return "order still open"
+        return None
+
+
+class MarketClosed:
+    """ skips everything while the market is closed, the clock is only asked
+        for again once the market is due to open or close
+
+    Args:
+        alpaca: (AlpacaTrading) used to get the market clock
+    """
+    name = "market_closed"
+
+    def __init__(self, alpaca):
+        self.alpaca = alpaca
+        self.is_open = None
+        self.next_change = None
+        self._lock = threading.Lock()
+
+    def __call__(self, symbol):
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            if self.next_change is None or now >= self.next_change:
+                clock = self.alpaca.get_clock()
+                self.is_open = clock.is_open
+                self.next_change = clock.next_close if clock.is_open else clock.next_open
+            if not self.is_open:
+                return f"market opens at {self.next_change}"
+        return None
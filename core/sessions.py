@@ -0,0 +1,58 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+def make_session(pool_size=10, pool_hosts=4) -> requests.Session:
+    """ Builds a keep-alive session so calls to the same host reuse their
+        connection instead of doing a new TLS handshake every time
+
+        usage example:
+            session = make_session(pool_size=8)
+            session.get('https://data.alpaca.markets/v1beta1/news')
+
+    Args:
+        pool_size: (int) connections kept open per host, should be at least
+            the number of workers that call the host at the same time
+        pool_hosts: (int) how many hosts to keep pools for
+
+    Returns:
+        Session: the session
+    """
+    session = requests.Session()
+    # retries are done by the rate limiter, not by urllib3
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def connection_stats(session: requests.Session) -> dict:
+    """ Counts the connections opened and requests made through a session,
+        when connections are reused there are far fewer connections than
+        requests
+
+    Returns:
+        dict: {"connections": int, "requests": int, "reuse_rate": float,
+               "hosts": {host: {"connections": int, "requests": int}}}
+    """
+    hosts = {}
+    # the http and https adapters are usually the same one
+    adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+    for adapter in adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = hosts.setdefault(pool.host, {"connections": 0, "requests": 0})
+            host["connections"] += pool.num_connections
+            host["requests"] += pool.num_requests
+
+    connections = sum(host["connections"] for host in hosts.values())
+    request_count = sum(host["requests"] for host in hosts.values())
+    return {
+        "connections": connections,
+        "requests": request_count,
+        # share of requests that didnt need a new connection
+        "reuse_rate": 1 - connections / request_count if request_count else 0.0,
+        "hosts": hosts,
+    }
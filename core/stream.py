@@ -0,0 +1,87 @@
+import random
+import ssl
+import time
+
+import websocket
+
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+class ReconnectingStream:
+    """ Base for alpacas websocket streams, runs the connection and keeps
+        reconnecting (with jittered exponential backoff) until stop is called.
+
+        subclasses implement on_open, on_message, on_error and on_close like a
+        websocket.WebSocketApp expects, and call _authenticated once the stream
+        has accepted them so the next reconnect starts from the smallest wait.
+
+    Args:
+        url: (str) the stream url
+        name: (str) what to call the stream in the logs
+        ping_interval: (float) seconds between pings to the server
+        ping_timeout: (float) seconds to wait for a pong before the connection
+            is considered dead and is reconnected
+        min_backoff: (float) seconds to wait before the first reconnect attempt
+        max_backoff: (float) the most seconds to wait between reconnect attempts
+    """
+
+    def __init__(self, url, name, ping_interval=20, ping_timeout=10, min_backoff=1, max_backoff=60):
+        self.url = url
+        self.name = name
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.ws = None
+        self.authenticated = False
+        self._connected = False
+        self._stopped = False
+
+    def run(self):
+        """ connects to the stream and keeps reconnecting until stop is called, blocks """
+        websocket.enableTrace(False)
+        attempt = 0
+        while not self._stopped:
+            ws = websocket.WebSocketApp(self.url,
+                                    on_open=self.on_open,
+                                    on_message=self.on_message,
+                                    on_error=self.on_error,
+                                    on_close=self.on_close)
+            self.ws = ws
+
+            # the pings make a silently dropped connection close within
+            # ping_interval + ping_timeout instead of hanging forever
+            ws.run_forever(sslopt={"cert_reqs": ssl.CERT_NONE},
+                           ping_interval=self.ping_interval,
+                           ping_timeout=self.ping_timeout)
+
+            self.authenticated = False
+            self._disconnected()
+            if self._stopped:
+                break
+
+            # start over from the smallest wait if the last connection got as
+            # far as authenticating
+            if self._connected:
+                attempt = 0
+            self._connected = False
+            backoff = min(self.max_backoff, self.min_backoff * 2 ** attempt)
+            backoff *= random.uniform(0.5, 1)
+            attempt += 1
+            logger.warning("%s disconnected, reconnecting in %.1fs", self.name, backoff)
+            time.sleep(backoff)
+
+    def stop(self):
+        """ closes the stream and stops run from reconnecting """
+        self._stopped = True
+        if self.ws is not None:
+            self.ws.close()
+
+    def _authenticated(self):
+        # called by the subclass every time the stream accepts our keys
+        self.authenticated = True
+        self._connected = True
+
+    def _disconnected(self):
+        """ called after every connection ends, on_close isnt always called """
@@ -0,0 +1,102 @@
+import json
+import threading
+from core import fast_json
+from core.log import get_logger
+from core.stream import ReconnectingStream
+
+logger = get_logger(__name__)
+
+PAPER_URL = "wss://paper-api.alpaca.markets/stream"
+LIVE_URL = "wss://api.alpaca.markets/stream"
+
+class TradeUpdates(ReconnectingStream):
+    """ Listens to alpacas trade updates stream (order accepted, filled,
+        canceled etc) and passes every update on
+
+        updates sent while the stream was down are not replayed, so on_connected
+        is called after every (re)authentication to resync from the rest api.
+
+        usage example:
+            trade_updates = TradeUpdates(api_key, api_secret, on_trade_update=portfolio.apply_trade_update,
+                                         on_connected=portfolio.resync)
+            threading.Thread(target=trade_updates.run, daemon=True).start()
+
+    Args:
+        api_key: alpaca api key
+        api_secret: alpaca secret key
+        on_trade_update: function called with the "data" of every trade update
+        on_connected: optional function called (in its own thread) every time
+            the stream is authorized, including the first time
+        paper: (bool) use the paper trading stream
+        url: (str) overrides the stream url, eg a local websocket server for testing
+        ping_interval: (float) seconds between pings to the server
+        ping_timeout: (float) seconds to wait for a pong before the connection
+            is considered dead and is reconnected
+        min_backoff: (float) seconds to wait before the first reconnect attempt
+        max_backoff: (float) the most seconds to wait between reconnect attempts
+    """
+
+    def __init__(self, api_key, api_secret, on_trade_update, on_connected=None, paper=True, url=None,
+                 ping_interval=20, ping_timeout=10, min_backoff=1, max_backoff=60):
+        super().__init__(url or (PAPER_URL if paper else LIVE_URL), "trade updates",
+                         ping_interval=ping_interval, ping_timeout=ping_timeout,
+                         min_backoff=min_backoff, max_backoff=max_backoff)
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.on_trade_update = on_trade_update
+        self.on_connected = on_connected
+        self.stats = {
+            "connects": 0,
+            "reconnects": 0,
+            "updates": 0,
+        }
+
+    def on_message(self, ws, message):
+
+        try:
+            # alpaca sends these as binary frames, loads takes bytes too
+            msg = fast_json.loads(message)
+            stream = msg.get('stream')
+            data = msg.get('data', {})
+
+            if stream == 'authorization':
+                if data.get('status') == 'authorized':
+                    self._authenticated()
+                    ws.send(json.dumps({"action": "listen", "data": {"streams": ["trade_updates"]}}))
+                    self._on_authorized()
+                else:
+                    logger.error("trade updates not authorized: %s", data)
+
+            elif stream == 'trade_updates':
+                self.stats["updates"] += 1
+                self.on_trade_update(data)
+
+        except Exception as error:
+            logger.exception("could not handle trade update: %s", error)
+
+    def on_error(self, ws, error):
+        logger.warning("trade updates error: %s", error)
+
+    def on_close(self, ws, close_status_code, close_msg):
+        self.authenticated = False
+        logger.warning("### trade updates closed ###")
+
+    def on_open(self, ws):
+        ws.send(json.dumps({"action": "auth", "key": self.api_key, "secret": self.api_secret}))
+
+    def _on_authorized(self):
+        """ called after every successful authorization """
+        self.stats["connects"] += 1
+        if self.stats["connects"] > 1:
+            self.stats["reconnects"] += 1
+            logger.info("trade updates reconnected, resyncing")
+
+        if self.on_connected is not None:
+            # the resync calls the rest api, dont hold up the websocket thread
+            threading.Thread(target=self._safe_on_connected, daemon=True).start()
+
+    def _safe_on_connected(self):
+        try:
+            self.on_connected()
+        except Exception as error:
+            logger.warning("trade updates resync failed: %s", error)
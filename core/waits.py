@@ -0,0 +1,177 @@
+import threading
+import time
+
+from selenium.common.exceptions import StaleElementReferenceException, TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+# loading indicators easy equities (and the libraries it uses) put on the page
+SPINNERS = ".loading-spinner, .spinner, .loader, .blockUI, .k-loading-mask"
+
+# pending jquery requests plus how many resources the page has loaded so far,
+# if neither changes for a while the page has stopped talking to the server
+NETWORK_SCRIPT = """
+return [
+    document.readyState,
+    window.jQuery ? window.jQuery.active : 0,
+    window.performance && performance.getEntriesByType ? performance.getEntriesByType('resource').length : 0
+];
+"""
+
+class Waiter:
+    """ Waits on what the page is doing instead of sleeping for a fixed time,
+        and keeps count of how long each kind of wait really took.
+
+        every wait only uses the webdriver, so it works the same against the
+        real site or a static html file in a headless browser.
+
+        usage example:
+            waiter = Waiter(driver)
+            waiter.visible((By.CSS_SELECTOR, '#loadHoldings'))
+            waiter.network_idle()
+            print(waiter.timings)
+
+    Args:
+        driver: a selenium webdriver
+        timeout: (float) default seconds to wait before giving up
+        poll: (float) seconds between checks
+    """
+
+    def __init__(self, driver, timeout=10, poll=0.1):
+        self.driver = driver
+        self.timeout = timeout
+        self.poll = poll
+        # wait name: {"count", "total", "max", "last", "timeouts"} in seconds
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def until(self, condition, name, timeout=None):
+        """ waits until condition(driver) returns something truthy and records
+            how long it took under name
+
+        Returns:
+            whatever the condition returned
+
+        Raises:
+            TimeoutException: if the condition isnt met in time
+        """
+        started = time.perf_counter()
+        try:
+            result = WebDriverWait(self.driver, timeout or self.timeout, poll_frequency=self.poll,
+                                   ignored_exceptions=(StaleElementReferenceException,)).until(condition)
+        except TimeoutException:
+            self._record(name, time.perf_counter() - started, timed_out=True)
+            raise
+        self._record(name, time.perf_counter() - started)
+        return result
+
+    def visible(self, locator, timeout=None):
+        """ Returns:
+                the element once it is displayed
+        """
+        return self.until(EC.visibility_of_element_located(locator), "visible", timeout)
+
+    def clickable(self, locator, timeout=None):
+        """ Returns:
+                the element once it is displayed and enabled
+        """
+        return self.until(EC.element_to_be_clickable(locator), "clickable", timeout)
+
+    def stable(self, locator, quiet=0.3, timeout=None):
+        """ waits until the element has stopped changing (text and size) for
+            quiet seconds, eg a list that is being filled in by javascript
+
+        Returns:
+            the element
+        """
+        return self.until(_Stable(locator, quiet), "stable", timeout)
+
+    def text_changed(self, locator, old_text, timeout=None):
+        """ waits until the elements text is no longer old_text
+
+        Returns:
+            the element
+        """
+        def changed(driver):
+            elements = driver.find_elements(*locator)
+            return elements[0] if elements and elements[0].text != old_text else False
+        return self.until(changed, "text_changed", timeout)
+
+    def gone(self, css_selector=SPINNERS, timeout=None):
+        """ waits until nothing matching the selector is displayed, by default
+            the loading spinners
+        """
+        def gone(driver):
+            return not any(element.is_displayed() for element in driver.find_elements(By.CSS_SELECTOR, css_selector))
+        return self.until(gone, "spinner_gone", timeout)
+
+    def network_idle(self, quiet=0.3, timeout=None):
+        """ waits until the page has loaded, there are no jquery requests
+            pending, no new resources have been fetched for quiet seconds and
+            no spinners are showing
+        """
+        return self.until(_NetworkIdle(quiet), "network_idle", timeout)
+
+    def _record(self, name, seconds, timed_out=False):
+        with self._lock:
+            timing = self.timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0, "timeouts": 0})
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            timing["last"] = seconds
+            if timed_out:
+                timing["timeouts"] += 1
+        logger.debug("%s wait took %.2fs%s", name, seconds, " (timed out)" if timed_out else "")
+
+
+class _Stable:
+    """condition that is met once the element looks the same for quiet seconds"""
+
+    def __init__(self, locator, quiet):
+        self.locator = locator
+        self.quiet = quiet
+        self.last = None
+        self.since = None
+
+    def __call__(self, driver):
+        elements = driver.find_elements(*self.locator)
+        if not elements:
+            self.last = None
+            return False
+        element = elements[0]
+        state = (element.text, element.size.get('width'), element.size.get('height'))
+        now = time.monotonic()
+        if state != self.last:
+            self.last = state
+            self.since = now
+            return False
+        return element if now - self.since >= self.quiet else False
+
+
+class _NetworkIdle:
+    """condition that is met once the network has been quiet for quiet seconds"""
+
+    def __init__(self, quiet):
+        self.quiet = quiet
+        self.last = None
+        self.since = None
+
+    def __call__(self, driver):
+        ready_state, active, resources = driver.execute_script(NETWORK_SCRIPT)
+        now = time.monotonic()
+        if ready_state != 'complete' or active:
+            self.last = None
+            return False
+        if resources != self.last:
+            self.last = resources
+            self.since = now
+            return False
+        if now - self.since < self.quiet:
+            return False
+        # the requests are done, wait for the page to finish showing them
+        return not any(element.is_displayed() for element in driver.find_elements(By.CSS_SELECTOR, SPINNERS))
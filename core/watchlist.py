@@ -0,0 +1,135 @@
+import os
+import threading
+from core.log import get_logger
+
+logger = get_logger(__name__)
+
+class Watchlist:
+    """ The set of symbols the bot trades, membership checks are O(1) and the
+        set is replaced as a whole on every change so it can be read from any
+        worker without a lock.
+
+        usage example:
+            watchlist = Watchlist(['AAPL', 'MSFT'])
+            watchlist.add(['TSLA'])
+            'TSLA' in watchlist
+
+    Args:
+        symbols: (list) the starting symbols, duplicates are ignored
+    """
+
+    def __init__(self, symbols=()):
+        self.symbols = frozenset(symbol.upper() for symbol in symbols)
+        self._lock = threading.Lock()
+
+    def __contains__(self, symbol):
+        return symbol in self.symbols
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def add(self, symbols) -> list:
+        """ adds symbols to the watchlist
+
+        Returns:
+            list: the symbols that were not already on the watchlist
+        """
+        with self._lock:
+            added = {symbol.upper() for symbol in symbols} - self.symbols
+            self.symbols = self.symbols | added
+        return sorted(added)
+
+    def remove(self, symbols) -> list:
+        """ removes symbols from the watchlist
+
+        Returns:
+            list: the symbols that were on the watchlist
+        """
+        with self._lock:
+            removed = {symbol.upper() for symbol in symbols} & self.symbols
+            self.symbols = self.symbols - removed
+        return sorted(removed)
+
+    def replace(self, symbols) -> tuple:
+        """ swaps the whole watchlist for a new set of symbols
+
+        Returns:
+            tuple: (added, removed) lists of symbols
+        """
+        with self._lock:
+            new = frozenset(symbol.upper() for symbol in symbols)
+            added, removed = new - self.symbols, self.symbols - new
+            self.symbols = new
+        return sorted(added), sorted(removed)
+
+
+class WatchlistFile:
+    """ Loads the watchlist from a text file and reloads it whenever the file
+        changes, so symbols can be added or removed without a restart.
+
+        the file has one or more symbols per line separated by commas or
+        spaces, anything after a # is a comment.
+
+        usage example:
+            watchlist_file = WatchlistFile('watchlist.txt', on_change=trading_bot.set_symbols)
+            watchlist_file.start()
+
+    Args:
+        path: (str) the watchlist file
+        on_change: function called with the list of symbols every time the
+            file is (re)loaded
+        interval: (float) seconds between checks for changes
+    """
+
+    def __init__(self, path, on_change, interval=5):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._mtime = None
+        self._stop = threading.Event()
+
+    def load(self) -> list:
+        """ Returns:
+                list: the symbols in the file
+        """
+        symbols = []
+        with open(self.path) as file:
+            for line in file:
+                line = line.split('#', 1)[0]
+                symbols.extend(symbol.strip().upper() for symbol in line.replace(',', ' ').split() if symbol.strip())
+        return symbols
+
+    def check(self) -> bool:
+        """ reloads the file if it changed since the last check
+
+        Returns:
+            bool: True if the file was reloaded
+        """
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError as error:
+            logger.warning("could not read watchlist file %s: %s", self.path, error)
+            return False
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        self.on_change(self.load())
+        return True
+
+    def start(self):
+        """ loads the file and keeps watching it on a background thread """
+        self.check()
+        threading.Thread(target=self._watch, name="watchlist-file", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as error:
+                logger.warning("could not reload the watchlist: %s", error)
@@ -1,8 +1,22 @@
 import json
-import yfinance as yf
+import threading
 from core.alpaca import AlpacaTrading
 from core.gpt import GPTBot
 from core.news import News
+from core.dispatcher import NewsDispatcher
+from core.coalescer import NewsCoalescer
+from core.portfolio import Portfolio
+from core.trade_updates import TradeUpdates
+from core.watchlist import Watchlist, WatchlistFile
+from core.bars import BarCache
+from core.batch import NewsBatch
+from core.decision import Decision
+from core.decision_cache import DecisionCache
+from core.relevance import RelevanceScorer
+from core.rules import PreFilter, InsufficientCapital, MaxPositions, Cooldown, PendingOrder, MarketClosed
+from core.log import get_logger, setup_logging
+from core.sessions import make_session, connection_stats
+from core import ratelimit
 
 # import env vaiables from env.py
 # before using this program you need to
@@ -12,51 +26,151 @@ from core.news import News
 # OPEN_AI_API_KEY = 'banana360kickflip'
 from env import ALPACA_API_KEY, ALPACA_SECRET_KEY, OPEN_AI_API_KEY
 
+logger = get_logger("main")
+
 class TradingBot():
     """ Wrapper for trading to make life easyer when accesing global variables
 
         usage example:
+            # use 'DEBUG' to see every news item and the full gpt prompts
+            setup_logging('INFO')
             trading_bot = TradingBot()
-            trading_bot.news.run()
+            trading_bot.run()
         
         idealy this should be run with systemctl and auto restart if it fails
     """
 
-    def __init__(self):
+    def __init__(self, workers=4, max_queue=100, dispatch_mode='thread', backpressure='block', bar_cache_dir=None, price_encoding='compact', stream_decisions=False, decision_cache_path=None, coalesce_window=2, watchlist_path=None, all_news=False, rate_limits=None, rules=None, relevance_threshold=0.35, news_log_path=None, http_pool_size=None, resync_interval=300):
+        """
+        Args:
+            workers: (int) how many symbols can be processed in parallel
+            max_queue: (int) max news jobs waiting per worker
+            dispatch_mode: (str) 'thread' or 'asyncio', see NewsDispatcher
+            backpressure: (str) what to do when the news queue is full,
+                'block', 'drop_newest' or 'drop_oldest', see NewsDispatcher
+            bar_cache_dir: (str) folder to persist price bars in between
+                restarts, bars are only kept in memory if None
+            price_encoding: (str) 'raw' to send gpt every close price or
+                'compact' to send a short feature summary, see core.features
+            stream_decisions: (bool) act on gpts decision as soon as its JSON
+                is complete instead of waiting for the feed back message
+            decision_cache_path: (str) json file to keep cached gpt decisions in
+                between restarts, decisions are only kept in memory if None
+            coalesce_window: (float) seconds to wait for more news on a symbol
+                before evaluating it, see NewsCoalescer
+            watchlist_path: (str) optional text file of symbols to trade, it is
+                reloaded whenever it changes, see WatchlistFile
+            all_news: (bool) subscribe to all news and filter by the watchlist
+                locally, better for very large watchlists
+            rate_limits: (dict) optional provider: RateLimiter arguments to
+                override the default limits, eg
+                {'openai': {'rate': 50, 'burst': 20, 'max_concurrency': 8}}
+            rules: (list) the pre-filter rules checked before gpt is asked,
+                defaults to the rules below, see core.rules
+            relevance_threshold: (float) news has to score at least this for a
+                symbol (see RelevanceScorer) to be evaluated, None to evaluate
+                all news
+            news_log_path: (str) optional json lines file every news item is
+                appended to, for tuning the relevance threshold offline
+            http_pool_size: (int) keep-alive connections per host for the
+                alpaca, openai and yfinance sessions, defaults to workers + 2
+            resync_interval: (float) seconds between reloading the positions
+                and open orders from alpaca, on top of the reload after every
+                trade updates reconnect, None to only reload on reconnect
+        """
+        # the openai, alpaca and yfinance limiters are shared by every worker
+        for provider, limits in (rate_limits or {}).items():
+            ratelimit.configure(provider, **limits)
+
+        # one keep-alive session per provider so the workers reuse connections
+        # instead of doing a tls handshake for every call
+        pool_size = http_pool_size or workers + 2
+        self.sessions = {provider: make_session(pool_size=pool_size) for provider in ('alpaca', 'openai', 'yfinance')}
+
         # init AlpacaTrading
         self.alpaca = AlpacaTrading(api_key=ALPACA_API_KEY,
                                     api_secret=ALPACA_SECRET_KEY,
-                                    paper=True)
+                                    paper=True,
+                                    session=self.sessions['alpaca'])
         
-        # get the ammount of money we can spend / have avalable in the account
-        self.balance = self.alpaca.get_available_cash()
-        self.original_balance = self.balance
-
-        # get all the current open positions
-        self.open_positions = self.alpaca.get_positions()
-
-        # updating open positions can take time
-        # so we only update the open positions when neccisary
-        self.update_positions = False
+        # the ammount of money we can spend / have avalable in the account and
+        # all the current open positions, loaded once and then kept up to date
+        # from the trade updates stream instead of asking alpaca after every order
+        self.portfolio = Portfolio(self.alpaca, last_price=self.last_price)
+        self.original_balance = self.portfolio.balance
+        self.trade_updates = TradeUpdates(api_key=ALPACA_API_KEY,
+                                          api_secret=ALPACA_SECRET_KEY,
+                                          on_trade_update=self.on_trade_update,
+                                          # nothing is replayed after a reconnect, catch up from the rest api
+                                          on_connected=self.refresh_positions,
+                                          paper=True)
 
         # some stocks that I want to focus on, later on when I sign up for the
         # news api I can add many more stocks
         # ideally we would load a bunch of stocks in here but it
         # costs quite a bit for the news api subscription.
-        self.target_symbols = ['AAPL', 'MSFT', 'GOOGL', 'NVDA', 'TSM', 'META', 'AVGO', 'AMD', 'TSLA', 'AMZN', 'RBLX', 'ACN', 'ATVI']
+        # (set backed so checking a symbol stays fast with thousands of them)
+        self.target_symbols = Watchlist(['AAPL', 'MSFT', 'GOOGL', 'NVDA', 'TSM', 'META', 'AVGO', 'AMD', 'TSLA', 'AMZN', 'RBLX', 'ACN', 'ATVI'])
 
         # add in the existing positions incase we need to close them
-        for position in self.open_positions:
-            self.target_symbols.append(position.symbol)
+        self.target_symbols.add(position.symbol for position in self.portfolio.get_positions())
         
+        # price bars are cached per symbol and only topped up with new bars
+        self.bars = BarCache(period='5d', interval='15m', cache_dir=bar_cache_dir, session=self.sessions['yfinance'])
+
+        # skips the gpt call (and the order) when the outcome is already
+        # decided, cheapest rules first: the pending order check reads the local
+        # open order index, only the market clock asks alpaca
+        self.prefilter = PreFilter(rules if rules is not None else [
+            InsufficientCapital(self.portfolio, min_capital=20),
+            MaxPositions(self.portfolio, max_positions=10),
+            Cooldown(seconds=900),
+            PendingOrder(self.alpaca),
+            MarketClosed(self.alpaca),
+        ])
+
+        # news that gets re-sent (same headline and summary) reuses the last decision
+        self.decision_cache = DecisionCache(ttl=1800, path=decision_cache_path)
+
         # initalise the GPT decision maker
-        self.gpt_Bot = GPTBot(OPEN_AI_API_KEY)
+        self.gpt_Bot = GPTBot(OPEN_AI_API_KEY,
+                              price_encoding=price_encoding,
+                              stream=stream_decisions,
+                              decision_cache=self.decision_cache,
+                              session=self.sessions['openai'])
+
+        # news that only mentions a symbol in passing never gets to gpt
+        self.relevance = RelevanceScorer(threshold=relevance_threshold) if relevance_threshold is not None else None
+        self.news_log_path = news_log_path
+        self._news_log_lock = threading.Lock()
+
+        # news arriving close together for a symbol is merged into one
+        # evaluation and each symbol only has one evaluation running at a time
+        self.coalescer = NewsCoalescer(handler=self.process_stock, window=coalesce_window)
+
+        # news is handed off to a pool of workers so the websocket thread
+        # never waits on yfinance / gpt / alpaca
+        self.dispatcher = NewsDispatcher(handler=self.coalescer.run,
+                                         workers=workers,
+                                         max_queue=max_queue,
+                                         mode=dispatch_mode,
+                                         backpressure=backpressure,
+                                         on_drop=self.coalescer.dropped)
+        self.coalescer.submit_job = self.dispatcher.submit
 
         # inintalise news and pass on_news
-        self.news = News(api_key=ALPACA_API_KEY, api_secret=ALPACA_SECRET_KEY, target_symbols=self.target_symbols, on_news=self.on_news)
+        self.news = News(api_key=ALPACA_API_KEY, api_secret=ALPACA_SECRET_KEY, target_symbols=self.target_symbols, on_news=self.on_news, all_news=all_news, session=self.sessions['alpaca'])
 
+        # the watchlist file replaces the default symbols above once loaded
+        self.watchlist_file = WatchlistFile(watchlist_path, on_change=self.set_symbols) if watchlist_path else None
 
-    def process_stock(self, symbol: str, news: dict=None, decision: dict=None):
+        # the stream can miss an update without disconnecting, so the local
+        # positions and open orders are reloaded every now and then as well
+        self.resync_interval = resync_interval
+        self._stop = threading.Event()
+
+
+    def process_stock(self, symbol: str, news: dict=None, decision: Decision=None, batch: NewsBatch=None):
 
         """ does processes the stock, this should be called every time news
             drops for a particular stock
@@ -64,107 +178,264 @@ class TradingBot():
             Args:
                 symbol: (str) the stock symbol to process.
                 news: (dict) the news for the stock, doesnt require any
-                    particular structure
+                    particular structure, can be a list of news if several
+                    news items were merged by the coalescer
+                decision: (Decision or dict) skip gpt and use this decision instead
+                batch: (NewsBatch) set when the news is about several of our
+                    symbols so gpt decides for all of them in one call
         """
 
-        print(f"processing {symbol}")
+        logger.info("processing %s", symbol)
 
-        # get the stock info from yahoo finance
-        ticker = yf.Ticker(symbol)
-        # then get a dataframe
-        dataframe = ticker.history(period='5d', interval='15m')[map(str.title, ['open', 'close', 'low', 'high', 'volume'])]
+        # dont bother gpt if nothing could come of it
+        if not decision:
+            reason = self.prefilter.check(symbol)
+            if reason is not None:
+                logger.info("skipping %s, %s", symbol, reason)
+                return
 
-        
+        # if the news is about several of our symbols fetch all of them in one
+        # go, the workers for the other symbols will then find their bars fresh
+        if batch is not None:
+            self.bars.prefetch(batch.symbols)
 
-        # get the position if there is one
-        position = False
-        for _position in self.open_positions:
-            if _position.symbol == symbol:
-                position = _position
-                break
-
-        
-        # compile the stock info to feed into gpt
-        stock_info = {
-            "news": json.dumps(news) if news is not None else None,
-            "price_history": dataframe.Close.values,
-            "open_position": position is not False,
-            "capital": self.balance,
-        }
-
-        # add in the position info if there is an open position
-        if position is not False:
-            stock_info['opening_price'] = position.avg_entry_price
-            stock_info['current_price'] = position.current_price
+        stock_info = self.get_stock_info(symbol, news)
 
         # get gpt to make a decision for us
+        if not decision and batch is not None:
+            decision = batch.decision(symbol, self.make_batch_decisions)
+            if not decision and batch.answered(symbol):
+                # a malformed batched answer has already been asked again on its own
+                logger.warning("no usable decision for %s, skipping", symbol)
+                return
         if not decision:
             decision = self.gpt_Bot.make_trading_decision(stock_info=stock_info, symbol=symbol)
+        if not decision:
+            logger.warning("no usable decision for %s, skipping", symbol)
+            return
+        if isinstance(decision, dict):
+            decision = Decision.from_dict(decision)
 
         # execute decision
-        if position is False and decision['buy']:
-
-            if self.balance < 20:
-                print('Not enough money, skipping purchase')
+        if not stock_info['open_position'] and decision.buy:
 
             # this isnt valid anymore, a better sollution needs to be made
-            # if decision['buy'] >= self.balance:
+            # if decision.buy >= self.portfolio.balance:
             #     print('gpt tried to spend more money than we said it should.')
-            #     decision['buy'] = self.original_balance * 0.1
+            #     decision.buy = self.original_balance * 0.1
 
             # buy the stock if gpt says so
-            print(f"buying {symbol}")
-
-            try:
-                self.alpaca.buy(symbol=symbol, qty=int(decision['buy']), trail_percent=decision['trail_percent'])
-            except Exception as error:
-                # must be an existing order
-                print(f"problem buying {symbol}")
-                print(error)
+            logger.info("buying %s", symbol)
 
-            self.update_positions = True
+            # doesnt wait for the order, on_order_done is called once it settles
+            self.alpaca.buy_async(symbol=symbol, qty=int(decision.buy), trail_percent=decision.trail_percent, callback=self.on_order_done)
+            self.prefilter.record_trade(symbol)
 
         # sell the stock if we have an open position and if gpt says so
-        elif stock_info['open_position'] and decision['sell']:
-            print(f"selling {symbol}")
+        elif stock_info['open_position'] and decision.sell:
+            logger.info("selling %s", symbol)
+
+            position = self.portfolio.get_position(symbol)
+            self.alpaca.sell_async(symbol=symbol, percentage=1, position_qty=position.qty if position is not None else None, callback=self.on_order_done)
+            self.prefilter.record_trade(symbol)
+
+        # when streaming the message is printed by GPTBot once it arrives
+        if decision.message:
+            logger.info("message from gpt for %s: %s", symbol, decision.message)
 
-            try:
-                self.alpaca.sell(symbol=symbol, percentage=1)
-            except Exception as error:
-                # must be an existing order
-                print(f"problem selling {symbol}")
-                print(error)
 
-            self.update_positions = True
+    def on_order_done(self, handle):
+        """ called once an order placed by process_stock is filled, canceled
+            or rejected
+        """
+        if handle.error is not None:
+            # must be an existing order
+            logger.warning("problem %s %s: %s", 'buying' if handle.side == 'buy' else 'selling', handle.symbol, handle.error)
+        elif handle.fill_latency is not None:
+            logger.info("%s %s filled %s @ %s in %.2fs", handle.side, handle.symbol, handle.filled_qty, handle.filled_avg_price, handle.fill_latency)
+        else:
+            logger.info("%s %s order %s", handle.side, handle.symbol, handle.status)
 
-        print(f"message from gpt:\n{decision['message']}\n")
+    def get_stock_info(self, symbol: str, news: dict=None) -> dict:
+        """ compiles the stock info to feed into gpt
 
-        # update open positions if necessary
-        if self.update_positions:
-            self.balance = self.alpaca.get_available_cash()
-            self.open_positions = self.alpaca.get_positions()
-            self.update_positions = False
+            Args:
+                symbol: (str) the stock symbol
+                news: (dict) the news for the stock
 
+            Returns:
+                dict: stock_info as described in GPTBot.make_trading_decision
+                    with an extra "symbol" key
+        """
+
+        # get the stock info from yahoo finance (cached, only new bars are downloaded)
+        dataframe = self.bars.get(symbol)
+
+        # get the position if there is one
+        position = self.portfolio.get_position(symbol)
+
+        stock_info = {
+            "symbol": symbol,
+            "news": json.dumps(news) if news is not None else None,
+            "price_history": dataframe.Close.values,
+            "bars": dataframe,
+            "open_position": position is not None,
+            "capital": self.portfolio.balance,
+        }
+
+        # add in the position info if there is an open position
+        if position is not None:
+            stock_info['opening_price'] = position.avg_entry_price
+            stock_info['current_price'] = position.current_price
+
+        return stock_info
+
+    def last_price(self, symbol: str) -> float:
+        """ the last cached close for the symbol, used by Portfolio to price open
+            buy orders, None if the bars havent been fetched
+        """
+        return self.bars.last_close(symbol)
+
+    def make_batch_decisions(self, symbols: list, news: dict) -> dict:
+        """ gets gpt to decide on several symbols that share the same news
+            with a single call, used by NewsBatch
+
+            Returns:
+                dict: symbol: decision
+        """
+        # symbols the pre-filter would skip arent worth asking gpt about
+        symbols = [symbol for symbol in symbols if self.prefilter.check(symbol, count=False) is None]
+        self.bars.prefetch(symbols)
+        stock_infos = [self.get_stock_info(symbol, news) for symbol in symbols]
+        return self.gpt_Bot.make_trading_decisions(stock_infos)
+
+    def refresh_positions(self):
+        """ reloads the balance, positions and open orders from alpaca, the maps are
+            swapped in whole so workers never see half of a refresh, and
+            any position we dont watch yet is added to the watchlist so it
+            can be closed
+        """
+        # orders first, the portfolio keeps holding back the cost of the buy
+        # orders that are still open
+        self.alpaca.refresh_orders()
+        self.portfolio.resync()
+        # finishes the async orders whose final trade update we missed
+        self.alpaca.poll_orders()
+        self.add_symbols(position.symbol for position in self.portfolio.get_positions())
+
+    def _resync(self):
+        while not self._stop.wait(self.resync_interval):
+            try:
+                self.refresh_positions()
+            except Exception as error:
+                logger.warning("could not resync with alpaca: %s", error)
+
+    def add_symbols(self, symbols: list):
+        """ starts watching more symbols without restarting the news stream """
+        added = self.target_symbols.add(symbols)
+        if added:
+            logger.info("watching %s", added)
+            self.news.subscribe(added)
+
+    def remove_symbols(self, symbols: list):
+        """ stops watching symbols, symbols we hold a position in are kept so
+            they can still be closed
+        """
+        held = {position.symbol for position in self.portfolio.get_positions()}
+        removed = self.target_symbols.remove(symbol for symbol in symbols if symbol.upper() not in held)
+        if removed:
+            logger.info("stopped watching %s", removed)
+            self.news.unsubscribe(removed)
+
+    def set_symbols(self, symbols: list):
+        """ replaces the watchlist (eg from the watchlist file), symbols we hold
+            a position in are always kept
+        """
+        held = [position.symbol for position in self.portfolio.get_positions()]
+        added, removed = self.target_symbols.replace(list(symbols) + held)
+        if added:
+            logger.info("watching %s", added)
+            self.news.subscribe(added)
+        if removed:
+            logger.info("stopped watching %s", removed)
+            self.news.unsubscribe(removed)
 
     def on_news(self, news):
-        """ function to run when ever news drops on a particular stock
+        """ function to run when ever news drops on a particular stock,
+            this runs on the websocket thread so it only queues the work
 
         Args:
             news: (dict) a dictionary with details from the news item.
                 no particular structure is neccisary
         """
 
-        print('got news: ', news)
+        logger.debug('got news: %s', news)
+        self.record_news(news)
+
+        # only run for our trageted symbols
+        symbols = [symbol for symbol in news["symbols"] if symbol in self.target_symbols]
+
+        # and only if the news is really about them
+        if self.relevance is not None:
+            symbols = [symbol for symbol in symbols if self.relevance.is_relevant(news, symbol)]
+
+        # news about several of our symbols gets one gpt call for all of them
+        batch = NewsBatch(symbols, news) if len(symbols) > 1 else None
 
-        for symbol in news["symbols"]:
-            # only run for our trageted symbols
-            if symbol in self.target_symbols:
-                self.process_stock(symbol, news)
+        for symbol in symbols:
+            self.coalescer.submit(symbol, news, batch=batch)
 
+    def on_trade_update(self, update: dict):
+        """ keeps the local balance, positions and open orders up to date,
+            called for every message on the trade updates stream
+        """
+        self.portfolio.apply_trade_update(update)
+        self.alpaca.apply_trade_update(update)
+
+    def connection_stats(self) -> dict:
+        """ Returns:
+                dict: provider: connections opened, requests made and the
+                    reuse rate, see core.sessions.connection_stats
+        """
+        return {provider: connection_stats(session) for provider, session in self.sessions.items()}
 
+    def record_news(self, news: dict):
+        """ appends the news item to news_log_path (if set) so the relevance
+            scorer can be tuned against real news later, see core.relevance
+        """
+        if self.news_log_path is None:
+            return
+        try:
+            with self._news_log_lock, open(self.news_log_path, 'a') as file:
+                file.write(json.dumps(news) + '\n')
+        except Exception as error:
+            logger.warning("could not record news: %s", error)
+
+    def run(self):
+        """ starts the news workers and then listens for news (blocks) """
+        self.dispatcher.start()
+        if self.watchlist_file is not None:
+            self.watchlist_file.start()
+        threading.Thread(target=self.trade_updates.run, name="trade-updates", daemon=True).start()
+        if self.resync_interval:
+            threading.Thread(target=self._resync, name="resync", daemon=True).start()
+        try:
+            # reconnects (and backfills missed news) on its own
+            self.news.run()
+        finally:
+            self._stop.set()
+            self.news.stop()
+            self.trade_updates.stop()
+            self.dispatcher.stop()
+            for provider, stats in self.connection_stats().items():
+                logger.info("%s: %d requests over %d connections (%.0f%% reused)", provider, stats['requests'], stats['connections'], stats['reuse_rate'] * 100)
+
+
+# use 'DEBUG' to see every news item and the full gpt prompts
+setup_logging('INFO')
 trading_bot = TradingBot()
 # trading_bot.process_stock(symbol="AAPL", news=None, decision=json.loads('{"buy": 1, "sell": null, "trail_percent": 6.0, "message": "The current news and price history for AAPL indicate positive sentiment and a potential increase in stock price. It is recommended to buy 19 shares of AAPL."}'))
 # trading_bot.process_stock(symbol="TSLA", news=None, decision={'buy': None, 'sell': True, 'trail_percent': 1.0, 'message': 'It is recommended to sell the NVDA stock.'})
-trading_bot.news.run()
+trading_bot.run()
 
 